@@ -7,21 +7,188 @@ try:
     from html import escape
 except ImportError:
     from cgi import escape
+try:
+    import brotli
+except ImportError:
+    brotli = None
 import shutil
 import mimetypes
 import re
 import signal
+import logging
+import asyncio
+import json
+import zlib
+import time
+import socket
+import stat
+import struct
+import uuid
+import hashlib
+import sqlite3
+import threading
+import queue
+import functools
+import multiprocessing
+import email.utils
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from io import StringIO, BytesIO
 import urllib.parse
 
 from urllib.parse import quote
 from urllib.parse import unquote
 from http.server import HTTPServer
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.server import BaseHTTPRequestHandler
 
 
 import datetime
 
+# Buffer size for the copy fallback when the kernel sendfile path can't be used.
+COPY_BUFSIZE = 1024 * 1024
+# The asyncio engine's loop.sendfile calls: --timeout applies to each.
+SENDFILE_SLICE = 1024 * 1024
+
+# With rate limits on, bodies go out in slices of this size, each paced by
+# the token buckets. Listings, search and HEAD never wait; file and zip
+# bodies don't either while the client has interactive allowance left: up
+# to INTERACTIVE_BYTES, refilled over INTERACTIVE_WINDOW seconds.
+SHAPE_CHUNK = 64 * 1024
+INTERACTIVE_BYTES = 256 * 1024
+INTERACTIVE_WINDOW = 10.0
+
+log = logging.getLogger('mediamaestro')
+access_log = logging.getLogger('mediamaestro.access')
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with any fields passed as extra={'fields': ...}."""
+
+    def format(self, record):
+        doc = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        doc.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            doc['exc'] = self.formatException(record.exc_info)
+        return json.dumps(doc, separators=(',', ':'))
+
+
+class Metrics:
+    """Process-wide counters, exported in the Prometheus text format.
+
+    Everything is updated under one lock by plain integer/float arithmetic,
+    so recording costs little more than the lock itself. With --workers each
+    process keeps and reports its own numbers.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # route -> [count per bucket..., +Inf count, sum]
+        self.latency = {}
+        self.responses = {}
+        self.sent = 0
+        self.received = 0
+        self.connections = 0
+        self.uploads = {True: 0, False: 0}
+        self.upload_bytes = 0
+        self.dedup_files = 0
+        self.dedup_bytes = 0
+        self.throttle_seconds = 0.0
+
+    def observe(self, route, code, seconds, sent):
+        with self.lock:
+            hist = self.latency.get(route)
+            if hist is None:
+                hist = self.latency[route] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += 1
+            hist[-1] += seconds
+            key = (route, code)
+            self.responses[key] = self.responses.get(key, 0) + 1
+            self.sent += sent
+
+    def connection(self, delta):
+        with self.lock:
+            self.connections += delta
+
+    def upload(self, ok, received):
+        with self.lock:
+            self.uploads[ok] += 1
+            self.upload_bytes += received
+            self.received += received
+
+    def throttled(self, seconds):
+        with self.lock:
+            self.throttle_seconds += seconds
+
+    def deduplicated(self, size):
+        with self.lock:
+            self.dedup_files += 1
+            self.dedup_bytes += size
+
+    def chunk(self, received):
+        """Counts the body of one resumable upload chunk."""
+        with self.lock:
+            self.upload_bytes += received
+            self.received += received
+
+    def render(self, caches, index=None):
+        """Returns the metrics page; caches maps a label to an LRUCache."""
+        out = []
+        with self.lock:
+            out.append('# HELP mediamaestro_request_duration_seconds Time to serve a request, by route.')
+            out.append('# TYPE mediamaestro_request_duration_seconds histogram')
+            for route, hist in sorted(self.latency.items()):
+                for bound, count in zip(self.BUCKETS, hist):
+                    out.append('mediamaestro_request_duration_seconds_bucket{route="%s",le="%g"} %d' % (route, bound, count))
+                out.append('mediamaestro_request_duration_seconds_bucket{route="%s",le="+Inf"} %d' % (route, hist[-2]))
+                out.append('mediamaestro_request_duration_seconds_count{route="%s"} %d' % (route, hist[-2]))
+                out.append('mediamaestro_request_duration_seconds_sum{route="%s"} %f' % (route, hist[-1]))
+            out.append('# TYPE mediamaestro_responses_total counter')
+            for (route, code), count in sorted(self.responses.items()):
+                out.append('mediamaestro_responses_total{route="%s",code="%s"} %d' % (route, code, count))
+            out.append('# TYPE mediamaestro_sent_bytes_total counter')
+            out.append('mediamaestro_sent_bytes_total %d' % self.sent)
+            out.append('# TYPE mediamaestro_received_bytes_total counter')
+            out.append('mediamaestro_received_bytes_total %d' % self.received)
+            out.append('# TYPE mediamaestro_active_connections gauge')
+            out.append('mediamaestro_active_connections %d' % self.connections)
+            out.append('# TYPE mediamaestro_uploads_total counter')
+            out.append('mediamaestro_uploads_total{result="ok"} %d' % self.uploads[True])
+            out.append('mediamaestro_uploads_total{result="failed"} %d' % self.uploads[False])
+            out.append('# TYPE mediamaestro_upload_bytes_total counter')
+            out.append('mediamaestro_upload_bytes_total %d' % self.upload_bytes)
+            out.append('# TYPE mediamaestro_deduplicated_files_total counter')
+            out.append('mediamaestro_deduplicated_files_total %d' % self.dedup_files)
+            out.append('# TYPE mediamaestro_deduplicated_bytes_total counter')
+            out.append('mediamaestro_deduplicated_bytes_total %d' % self.dedup_bytes)
+            out.append('# TYPE mediamaestro_throttle_seconds_total counter')
+            out.append('mediamaestro_throttle_seconds_total %f' % self.throttle_seconds)
+        out.append('# TYPE mediamaestro_cache_requests_total counter')
+        for name, cache in sorted(caches.items()):
+            out.append('mediamaestro_cache_requests_total{cache="%s",result="hit"} %d' % (name, cache.hits))
+            out.append('mediamaestro_cache_requests_total{cache="%s",result="miss"} %d' % (name, cache.misses))
+        out.append('# TYPE mediamaestro_cache_bytes gauge')
+        for name, cache in sorted(caches.items()):
+            out.append('mediamaestro_cache_bytes{cache="%s"} %d' % (name, cache.size))
+        if index is not None:
+            out.append('# TYPE mediamaestro_search_index_entries gauge')
+            out.append('mediamaestro_search_index_entries %d' % (len(index.entries) - len(index.free)))
+            out.append('# TYPE mediamaestro_search_index_ready gauge')
+            out.append('mediamaestro_search_index_ready %d' % index.ready)
+        return ('\n'.join(out) + '\n').encode('utf-8')
+
+
+metrics = Metrics()
+
 def format_size(size):
     """Formats the file size in a human-readable format."""
     for unit in ['', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB']:
@@ -34,154 +201,2263 @@ def format_date(timestamp):
     """Formats the modification time in a human-readable format."""
     return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
+def make_etag(st, weak=False):
+    """Builds an ETag from the inode, size and mtime of a stat result."""
+    tag = '"%x-%x-%x"' % (st.st_ino, st.st_size, st.st_mtime_ns)
+    return 'W/' + tag if weak else tag
+
+def etag_matches(header, etag):
+    """Weak comparison of etag against an If-None-Match style list."""
+    if header.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+def parse_http_date(value):
+    """Parses an HTTP date into a POSIX timestamp, or None if it is malformed."""
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+# More ranges than this in one request is treated as abuse and the header ignored.
+MAX_RANGES = 100
+
+def parse_range(header, size):
+    """Parses a Range header against a file of the given size.
+
+    Returns None when the header should be ignored (absent, malformed or not
+    in bytes), an empty list when no range is satisfiable, and otherwise a list
+    of inclusive (start, end) pairs in the order they were requested. If any
+    of them overlap, they are merged and returned in file order instead.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    specs = spec.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for item in specs:
+        first, sep, last = item.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                if start < 0:
+                    return None
+                if last:
+                    end = int(last)
+                    if end < start:
+                        return None
+                else:
+                    end = size - 1
+            else:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix == 0:
+                    continue
+                start, end = max(size - suffix, 0), size - 1
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return ranges if len(merged) == len(ranges) else merged
+
+
+def scan_directory(path, match=None):
+    """Lists path with os.scandir, statting each entry once.
+
+    Returns (dirs, files) as lists of (linkname, display_name, size, mtime);
+    directories and symbolic links go in dirs. match, if given, filters on
+    the entry name.
+    """
+    dirs = []
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            name = entry.name
+            if match is not None and not match(name):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                # Dangling symlink: describe the link itself.
+                st = entry.stat(follow_symlinks=False)
+            display_name = linkname = name
+            # Append / for directories or @ for symbolic links
+            is_dir = stat.S_ISDIR(st.st_mode)
+            is_link = entry.is_symlink()
+            if is_dir:
+                display_name = name + "/"
+                linkname = name + "/"
+            if is_link:
+                display_name = name + "@"
+                # Note: a link to a directory displays with @ and links with /
+            if is_dir or is_link:
+                dirs.append((linkname, display_name, st.st_size, st.st_mtime))
+            else:
+                files.append((linkname, display_name, st.st_size, st.st_mtime))
+    return dirs, files
+
+
+LISTING_HEAD = (
+    b'<style>\n'
+    b'body { font-family: Arial, sans-serif; margin: 0; padding: 0; background-color: #F2F2F2; }\n'
+    b'.container { max-width: 800px; margin: 0 auto; padding: 20px; background-color: #FFF; box-shadow: 0 0 10px rgba(0, 0, 0, 0.3); }\n'
+    b'img { display: block; width: 60%; margin-left: auto; margin-right: auto;}\n'
+    b'h1 { text-align: center; margin-bottom: 20px; }\n'
+    b'form { display: flex; flex-direction: column; align-items: center; margin-bottom: 20px; }\n'
+    b'input[type="file"] { margin-bottom: 10px; }\n'
+    b'input[type="submit"] { background-color: #13274D; color: #FFF; padding: 10px; border: none; border-radius: 5px; cursor: pointer; transition: background-color 0.2s ease-in-out; }\n'
+    b'input[type="submit"]:hover { background-color: #3E8E41; }\n'
+    b'table { border-collapse: collapse; width: 100%; margin-bottom: 20px; }\n'
+    b'th, td { padding: 10px; text-align: left; border-bottom: 1px solid #ddd; }\n'
+    b'th { background-color: #13274D; color: #FFF; }\n'
+    b'a { color: #000; text-decoration: none; }\n'
+    b'a:hover { text-decoration: underline; }\n'
+    b'</style>\n'
+    b'</head>\n'
+    b'<img width=\"400\" src=\"https://images2.imgbox.com/46/aa/qG7wrGvc_o.png\">\n'
+    b'<h1>Share files</h1>\n'
+    b"<hr>\n"
+    b"<h1>Upload File</h1>\n"
+    b"<form ENCTYPE=\"multipart/form-data\" method=\"post\" style=\"margin-bottom: 1em;\">\n"
+    b"<input name=\"file\" type=\"file\" multiple style=\"margin-right: 0.5em;\" />\n"
+    b"<input type=\"submit\" value=\"Upload File\" class=\"btn btn-primary\" />\n"
+    b"</form>\n"
+    b"<form action=\"/search\" method=\"get\">\n"
+    b"<label for=\"search\">Search:</label>\n"
+    b"<input type=\"search\" id=\"search\" name=\"q\" placeholder=\"Search...\">\n"
+    b"<button type=\"submit\">Go</button>\n"
+    b"</form>\n"
+    b"<hr>\n<ul>\n"
+)
+
+
+# Listing bodies are yielded in pieces of about this many bytes.
+LISTING_CHUNK = 64 * 1024
+SORT_KEYS = {
+    'name': lambda e: e[0].lower(),
+    'size': lambda e: e[2],
+    'mtime': lambda e: e[3],
+}
+
+
+def iter_listing(display_path, dirs, files, nav=b'', media=None):
+    """Yields the listing page for the entries returned by scan_directory.
+
+    nav is extra markup, such as pagination links, placed above the tables.
+    media, if given and not empty, maps file linknames to probe_media
+    results and adds an Info column to the files table.
+    """
+    f = BytesIO()
+    f.write(b'<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
+    f.write(b'<html>\n<head>\n')
+    f.write(b'<title>Directory listing for %s</title>\n' % display_path.encode('utf-8'))
+    f.write(LISTING_HEAD)
+    f.write(nav)
+    debug = log.isEnabledFor(logging.DEBUG)
+    for title, entries in ((b'Directories', dirs), (b'Files', files)):
+        info = media if title == b'Files' and media else None
+        f.write(b'<hr>\n<h2>%s:</h2>\n' % title)
+        f.write(b'<table style="width:100%" align="center">\n')
+        f.write(b'<tr>\n<th>Name</th>\n<th>Size</th>\n<th>Last Modified</th>\n')
+        if info is not None:
+            f.write(b'<th>Info</th>\n')
+        f.write(b'</tr>\n')
+        for linkname, display_name, size, modified_time in entries:
+            if debug:
+                log.debug("%s %s %s %s", linkname, display_name, size, modified_time)
+            f.write(b'<tr>\n')
+            f.write(b'<td><a href="%s">%s</a></td>\n' % (quote(linkname).encode('utf-8'), escape(display_name).encode('utf-8')))
+            f.write(b'<td>%s</td>\n' % format_size(size).encode('utf-8'))
+            f.write(b'<td>%s</td>\n' % format_date(modified_time).encode('utf-8'))
+            if info is not None:
+                meta = info.get(linkname)
+                f.write(b'<td>%s</td>\n' % format_media(meta).encode('utf-8') if meta else b'<td></td>\n')
+            f.write(b'</tr>\n')
+            if f.tell() >= LISTING_CHUNK:
+                yield f.getvalue()
+                f = BytesIO()
+        f.write(b'</table>\n')
+    f.write(b"</ul>\n<hr>\n</body>\n</html>\n")
+    yield f.getvalue()
+
+
+def render_listing(display_path, dirs, files, nav=b'', media=None):
+    """Renders the whole listing page at once; see iter_listing."""
+    return b''.join(iter_listing(display_path, dirs, files, nav, media))
+
+
+def iter_json_listing(url_path, dirs, files, total, offset, limit, media=None):
+    """Yields a compact JSON document describing one page of a listing.
+
+    url_path is the decoded request path; JSON needs no HTML escaping.
+    """
+    head = {'path': url_path, 'total': total, 'offset': offset, 'limit': limit}
+    yield json.dumps(head, separators=(',', ':'))[:-1].encode('utf-8') + b',"entries":['
+    parts = []
+    size = 0
+    first = True
+    for group, entries in ((True, dirs), (False, files)):
+        for linkname, display_name, entry_size, modified_time in entries:
+            if not group:
+                kind, name = 'file', display_name
+            elif display_name.endswith('@'):
+                kind, name = 'link', display_name[:-1]
+            else:
+                kind, name = 'dir', display_name[:-1]
+            doc = {'name': name, 'type': kind, 'size': entry_size, 'mtime': modified_time}
+            if media and not group and linkname in media:
+                doc['media'] = media[linkname]
+            item = json.dumps(doc, separators=(',', ':')).encode('utf-8')
+            if not first:
+                item = b',' + item
+            first = False
+            parts.append(item)
+            size += len(item)
+            if size >= LISTING_CHUNK:
+                yield b''.join(parts)
+                parts = []
+                size = 0
+    parts.append(b']}')
+    yield b''.join(parts)
+
+
+def parse_listing_options(query):
+    """Reads sort/order/offset/limit/format from a parsed query string.
+
+    Raises ValueError for values the listing doesn't understand.
+    """
+    sort = query.get('sort', ['name'])[0]
+    order = query.get('order', ['asc'])[0]
+    fmt = query.get('format', ['html'])[0]
+    offset = int(query.get('offset', ['0'])[0])
+    limit = query.get('limit', [None])[0]
+    limit = int(limit) if limit is not None else None
+    if sort not in SORT_KEYS or order not in ('asc', 'desc') or fmt not in ('html', 'json'):
+        raise ValueError(sort, order, fmt)
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError(offset, limit)
+    return fmt, sort, order, offset, limit
+
+
+# Rough memory held per scanned entry, for sizing scan_cache.
+SCAN_ENTRY_BYTES = 256
+
+
+def sorted_scan(path, sort, version):
+    """scan_directory(path) with each group sorted ascending by sort.
+
+    The result is kept in scan_cache under the directory's version, so
+    paging through a big directory scans and sorts it once, not per page.
+    """
+    key = (path, sort)
+    scan = scan_cache.get(key, version)
+    if scan is None:
+        dirs, files = scan_directory(path)
+        sort_key = SORT_KEYS[sort]
+        scan = (sorted(dirs, key=sort_key), sorted(files, key=sort_key))
+        scan_cache.put(key, version, scan)
+    return scan
+
+
+def slice_sorted(items, start, end, reverse):
+    """items[start:end] of the ascending list items, or of its reverse."""
+    if not reverse:
+        return items[start:end]
+    n = len(items)
+    end = n if end is None else min(end, n)
+    start = min(start, n)
+    return items[n - end:n - start][::-1]
+
+
+def paginate(dirs, files, order, offset, limit):
+    """Slices one page out of directories-then-files, both sorted ascending."""
+    reverse = order == 'desc'
+    end = None if limit is None else offset + limit
+    page_dirs = slice_sorted(dirs, offset, end, reverse)
+    file_offset = max(offset - len(dirs), 0)
+    file_end = None if end is None else max(end - len(dirs), 0)
+    return page_dirs, slice_sorted(files, file_offset, file_end, reverse)
+
+
+def pagination_nav(query, total, offset, limit):
+    """Builds the 'previous / next' links for a paginated HTML listing."""
+    if limit is None or (offset == 0 and total <= limit):
+        return b''
+    nav = b'<p>%d-%d of %d' % (min(offset + 1, total), min(offset + limit, total), total)
+    for label, target in ((b'previous', offset - limit), (b'next', offset + limit)):
+        if target < 0 and offset > 0:
+            target = 0
+        if 0 <= target < total and target != offset:
+            params = dict((k, v[0]) for k, v in query.items())
+            params['offset'] = target
+            link = '?' + urllib.parse.urlencode(params)
+            nav += b' <a href="%s">%s</a>' % (escape(link).encode('utf-8'), label)
+    return nav + b'</p>\n'
+
+
+def cached_stream(chunks, key, version):
+    """Passes chunks through, storing the complete body in listing_cache."""
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            parts.append(chunk)
+            size += len(chunk)
+            if size > listing_cache.max_bytes:
+                parts = None
+        yield chunk
+    if parts is not None:
+        listing_cache.put(key, version, b''.join(parts))
+
+
+class LRUCache:
+    """LRU cache of response bodies, bounded by their total size in bytes.
+
+    Each key holds one body together with the version it was built from (a
+    directory mtime, or a file's mtime and size), so a changed source simply
+    misses and gets rebuilt.
+    """
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        # Bytes charged for a body; len unless it isn't a bytes object.
+        self.sizeof = sizeof
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None or item[0] != version:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return item[1]
+
+    def put(self, key, version, body):
+        if self.sizeof(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= self.sizeof(old[1])
+            self.entries[key] = (version, body)
+            self.size += self.sizeof(body)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+
+listing_cache = LRUCache(64 * 1024 * 1024)
+compressed_cache = LRUCache(32 * 1024 * 1024)
+# (path, sort key) -> sorted (dirs, files), for paging without rescanning.
+scan_cache = LRUCache(64 * 1024 * 1024, sizeof=lambda scan: SCAN_ENTRY_BYTES * (len(scan[0]) + len(scan[1])))
+
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+)
+
+
+def is_compressible(content_type):
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    return (content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+            or content_type.endswith('+json') or content_type.endswith('+xml'))
+
+
+def choose_encoding(header):
+    """Picks br or gzip from an Accept-Encoding header, or None for identity."""
+    if not header:
+        return None
+    prefs = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        prefs[coding.strip().lower()] = q
+    offered = ('br', 'gzip') if brotli is not None else ('gzip',)
+    best = None
+    best_q = 0.0
+    for coding in offered:
+        q = prefs.get(coding, prefs.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def encoded_etag(etag, encoding):
+    """Gives each content-coding of a resource its own entity tag."""
+    return etag[:-1] + '-' + encoding + '"'
+
+
+def compressor(encoding):
+    if encoding == 'br':
+        return brotli.Compressor(quality=5)
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def compress_bytes(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+
+def compress_stream(chunks, encoding):
+    """Compresses an iterable of byte strings on the fly."""
+    c = compressor(encoding)
+    if encoding == 'br':
+        for chunk in chunks:
+            out = c.process(chunk)
+            if out:
+                yield out
+        yield c.finish()
+    else:
+        for chunk in chunks:
+            out = c.compress(chunk)
+            if out:
+                yield out
+        yield c.flush()
+
+
+def file_remaining(f, offset):
+    """Bytes from offset to the end of the regular file f, or None if f isn't one."""
+    try:
+        st = os.fstat(f.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    return max(st.st_size - offset, 0) if stat.S_ISREG(st.st_mode) else None
+
+
+def iter_file(f):
+    """Reads f in COPY_BUFSIZE pieces and closes it when done."""
+    try:
+        while True:
+            buf = f.read(COPY_BUFSIZE)
+            if not buf:
+                break
+            yield buf
+    finally:
+        f.close()
+
+
+# Entries, sizes or offsets from these on are written with ZIP64 records.
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+ZIP_FLAGS = 0x08 | 0x800  # sizes in a trailing data descriptor; UTF-8 names
+
+
+def dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def walk_zip_entries(root):
+    """Yields (archive name, full path, stat) for a directory tree, sorted."""
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, rel)) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            if is_upload_temp(entry.name):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            name = posixpath.join(rel, entry.name) if rel else entry.name
+            if stat.S_ISDIR(st.st_mode):
+                # Like the search index, don't descend through symlinks.
+                if not entry.is_symlink():
+                    yield name + '/', entry.path, st
+                    subdirs.append(name)
+            elif stat.S_ISREG(st.st_mode):
+                yield name, entry.path, st
+        stack.extend(reversed(subdirs))
+
+
+def iter_zip(root, deflate_name=None):
+    """Streams a ZIP archive of root without temp files or a full copy in memory.
+
+    Each member's CRC and sizes follow its data in a data descriptor, so file
+    contents are read once and passed straight through. Members whose name
+    deflate_name accepts are deflated; everything else (media, archives) is
+    stored. ZIP64 records are written only where a size, offset or entry
+    count needs them. Only the central directory, about a hundred bytes per
+    member, is held until the end.
+    """
+    central = []
+    offset = 0
+    pending = []
+    pending_size = 0
+    for name, full, st in walk_zip_entries(root):
+        is_dir = name.endswith('/')
+        f = None
+        if not is_dir:
+            try:
+                f = open(full, 'rb')
+            except OSError:
+                continue
+        encoded = name.encode('utf-8')
+        method = 8 if not is_dir and deflate_name is not None and deflate_name(name) else 0
+        # Deflate can outgrow its input slightly, so leave headroom.
+        zip64 = st.st_size >= ZIP64_LIMIT - (1 << 20) and not is_dir
+        mod_time, mod_date = dos_datetime(st.st_mtime)
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        flags = 0x800 if is_dir else ZIP_FLAGS
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, flags, method,
+                             mod_time, mod_date, 0, 0xFFFFFFFF if zip64 else 0,
+                             0xFFFFFFFF if zip64 else 0, len(encoded), len(extra))
+        header_offset = offset
+        pending.append(header + encoded + extra)
+        pending_size += len(pending[-1])
+        offset += len(pending[-1])
+        crc = 0
+        usize = csize = 0
+        if f is not None:
+            deflater = zlib.compressobj(6, zlib.DEFLATED, -15) if method == 8 else None
+            try:
+                while True:
+                    buf = f.read(COPY_BUFSIZE)
+                    if not buf:
+                        break
+                    crc = zlib.crc32(buf, crc)
+                    usize += len(buf)
+                    if deflater is not None:
+                        buf = deflater.compress(buf)
+                        if not buf:
+                            continue
+                    csize += len(buf)
+                    if pending:
+                        yield b''.join(pending)
+                        pending = []
+                        pending_size = 0
+                    yield buf
+                if deflater is not None:
+                    buf = deflater.flush()
+                    csize += len(buf)
+                    pending.append(buf)
+                    pending_size += len(buf)
+            finally:
+                f.close()
+            offset += csize
+            if zip64:
+                descriptor = struct.pack('<IIQQ', 0x08074b50, crc, csize, usize)
+            else:
+                descriptor = struct.pack('<IIII', 0x08074b50, crc, csize, usize)
+            pending.append(descriptor)
+            pending_size += len(descriptor)
+            offset += len(descriptor)
+        mode = (st.st_mode & 0xFFFF) << 16
+        if is_dir:
+            mode |= 0x10
+        central.append((encoded, flags, method, mod_time, mod_date, crc, csize, usize, header_offset, mode))
+        if pending_size >= LISTING_CHUNK:
+            yield b''.join(pending)
+            pending = []
+            pending_size = 0
+
+    cd_offset = offset
+    cd_size = 0
+    for encoded, flags, method, mod_time, mod_date, crc, csize, usize, header_offset, mode in central:
+        fields = []
+        if usize >= ZIP64_LIMIT:
+            fields.append(usize)
+            usize = 0xFFFFFFFF
+        if csize >= ZIP64_LIMIT:
+            fields.append(csize)
+            csize = 0xFFFFFFFF
+        if header_offset >= ZIP64_LIMIT:
+            fields.append(header_offset)
+            header_offset = 0xFFFFFFFF
+        extra = struct.pack('<HH%dQ' % len(fields), 1, 8 * len(fields), *fields) if fields else b''
+        version = 45 if fields else 20
+        record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, flags,
+                             method, mod_time, mod_date, crc, csize, usize, len(encoded), len(extra),
+                             0, 0, 0, mode, header_offset) + encoded + extra
+        pending.append(record)
+        pending_size += len(record)
+        cd_size += len(record)
+        if pending_size >= LISTING_CHUNK:
+            yield b''.join(pending)
+            pending = []
+            pending_size = 0
+
+    count = len(central)
+    if count >= ZIP64_COUNT_LIMIT or cd_size >= ZIP64_LIMIT or cd_offset >= ZIP64_LIMIT:
+        eocd64_offset = cd_offset + cd_size
+        pending.append(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+                                   count, count, cd_size, cd_offset))
+        pending.append(struct.pack('<IIQI', 0x07064b50, 0, eocd64_offset, 1))
+        count = min(count, 0xFFFF)
+        cd_size = min(cd_size, 0xFFFFFFFF)
+        cd_offset = min(cd_offset, 0xFFFFFFFF)
+    pending.append(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0))
+    yield b''.join(pending)
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """In-memory filename index over the whole served tree.
+
+    A background thread walks the tree and rescans only the directories whose
+    mtime changed since the last pass. Every name is posted under its
+    lowercase trigrams, so a query intersects a few posting sets and then
+    confirms the substring on the survivors instead of touching every entry.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.ready = False
+        self.lock = threading.Lock()
+        # rel_dir -> (mtime_ns, entry ids, child dirs)
+        self.dirs = {}
+        # id -> (rel_path, lowercase name, is_dir, size, mtime), None once freed
+        self.entries = []
+        self.free = []
+        self.grams = {}
+        # size -> ids of regular files, for the dedup size prefilter
+        self.sizes = {}
+
+    def start(self, interval):
+        thread = threading.Thread(target=self.run, args=(interval,), daemon=True)
+        thread.start()
+
+    def run(self, interval):
+        while True:
+            try:
+                self.refresh()
+            except OSError:
+                pass
+            self.ready = True
+            time.sleep(interval)
+
+    def refresh(self):
+        """Walks the tree once, reindexing the directories that changed."""
+        seen = set()
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            seen.add(rel)
+            full = os.path.join(self.root, rel)
+            try:
+                mtime_ns = os.stat(full).st_mtime_ns
+            except OSError:
+                continue
+            known = self.dirs.get(rel)
+            if known is not None and known[0] == mtime_ns:
+                stack.extend(known[2])
+                continue
+            try:
+                scanned = self.scan(rel, full)
+            except OSError:
+                continue
+            children = [path for path, _, is_dir, _, _ in scanned if is_dir]
+            with self.lock:
+                if known is not None:
+                    self.remove(known[1])
+                ids = [self.add(entry) for entry in scanned]
+                self.dirs[rel] = (mtime_ns, ids, children)
+            stack.extend(children)
+        with self.lock:
+            for rel in [rel for rel in self.dirs if rel not in seen]:
+                self.remove(self.dirs.pop(rel)[1])
+
+    def scan(self, rel, full):
+        entries = []
+        with os.scandir(full) as it:
+            for entry in it:
+                if is_upload_temp(entry.name):
+                    # Unfinished uploads aren't searchable, but the walk is
+                    # how the session sweeper learns about old sessions.
+                    note_session_dir(full)
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                # Symlinked directories are indexed as plain entries and not
+                # descended into, which keeps link cycles out of the walk.
+                is_dir = stat.S_ISDIR(st.st_mode)
+                path = posixpath.join(rel, entry.name) if rel else entry.name
+                entries.append((path, entry.name.lower(), is_dir, st.st_size, st.st_mtime))
+        return entries
+
+    def add(self, entry):
+        if self.free:
+            entry_id = self.free.pop()
+            self.entries[entry_id] = entry
+        else:
+            entry_id = len(self.entries)
+            self.entries.append(entry)
+        for gram in trigrams(entry[1]):
+            self.grams.setdefault(gram, set()).add(entry_id)
+        if not entry[2]:
+            self.sizes.setdefault(entry[3], set()).add(entry_id)
+        return entry_id
+
+    def remove(self, ids):
+        for entry_id in ids:
+            entry = self.entries[entry_id]
+            if not entry[2]:
+                same = self.sizes.get(entry[3])
+                if same is not None:
+                    same.discard(entry_id)
+                    if not same:
+                        del self.sizes[entry[3]]
+            for gram in trigrams(entry[1]):
+                posting = self.grams.get(gram)
+                if posting is not None:
+                    posting.discard(entry_id)
+                    if not posting:
+                        del self.grams[gram]
+            self.entries[entry_id] = None
+            self.free.append(entry_id)
+
+    def files_of_size(self, size):
+        """Returns the paths of the regular files of exactly size bytes."""
+        with self.lock:
+            return [self.entries[i][0] for i in self.sizes.get(size, ())]
+
+    def search(self, query, offset=0, limit=100):
+        """Returns (total, entries) for names containing query, ordered by path."""
+        query = query.lower()
+        with self.lock:
+            grams = trigrams(query)
+            if grams:
+                postings = sorted((self.grams.get(gram, ()) for gram in grams), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+                matches = [self.entries[i] for i in candidates if query in self.entries[i][1]]
+            else:
+                matches = [e for e in self.entries if e is not None and query in e[1]]
+        matches.sort()
+        return len(matches), matches[offset:offset + limit]
+
+
+# Longest request line plus headers the asyncio engine will buffer.
+MAX_REQUEST_HEAD = 64 * 1024
+# Upload bodies are read and scanned in chunks of this size.
+UPLOAD_CHUNK = 1024 * 1024
+MAX_PART_HEADER = 16 * 1024
+
+
+class UploadError(Exception):
+
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def unique_name(directory, filename):
+    """Strips any client-side path from filename and resolves it in directory."""
+    filename = os.path.basename(filename.replace('\\', '/'))
+    if filename in ('', os.curdir, os.pardir):
+        raise UploadError("Can't find file name")
+    if '\0' in filename:
+        raise UploadError("Invalid file name")
+    return os.path.join(directory, filename)
+
+
+def link_unused(src, fn):
+    """Hardlinks src as fn, appending "_" to fn until the name is unused."""
+    while True:
+        try:
+            os.link(src, fn)
+            return fn
+        except FileExistsError:
+            fn += "_"
+
+
+def commit_upload(tmp_path, fn):
+    """Moves a finished upload into place without replacing an existing file.
+
+    Returns the final name, which gets "_" appended until it is unused.
+    """
+    try:
+        fn = link_unused(tmp_path, fn)
+    except OSError:
+        # No hardlinks on this filesystem: check-then-rename instead.
+        while os.path.exists(fn):
+            fn += "_"
+        os.rename(tmp_path, fn)
+        return fn
+    os.unlink(tmp_path)
+    return fn
+
+
+# Smaller files aren't worth a hash lookup or a shared inode.
+DEDUP_MIN_SIZE = 4096
+
+
+class SQLiteStore:
+    """SQLite database shared by worker processes, one connection per thread."""
+
+    schema = ()
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        db = self.db()
+        for statement in self.schema:
+            db.execute(statement)
+        db.commit()
+
+    def db(self):
+        """Returns this thread's connection; sqlite3 ones can't be shared."""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.db_path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+
+def default_cache_db(root, name):
+    """Per-tree database file under the user's cache directory."""
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    directory = os.path.join(cache, 'mediamaestro')
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256(root.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    return os.path.join(directory, '%s-%s.db' % (name, digest))
+
+
+class HashIndex(SQLiteStore):
+    """Persistent SHA-256 index of the served tree, for deduplicating uploads.
+
+    Rows are (path, size, mtime_ns, sha256) in SQLite, so worker processes
+    share them and they survive restarts. Existing files are hashed lazily:
+    only when an upload of the same size has to be compared against them,
+    and again only once their size or mtime has changed.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)',
+        'CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)',
+    )
+
+    def __init__(self, root, db_path):
+        SQLiteStore.__init__(self, db_path)
+        self.root = root
+
+    def add(self, path, digest, st=None):
+        if st is None:
+            st = os.stat(path)
+        db = self.db()
+        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, st.st_size, st.st_mtime_ns, digest))
+        db.commit()
+
+    def hash_file(self, path):
+        """Returns path's digest, from the index if the file hasn't changed."""
+        st = os.stat(path)
+        row = self.db().execute('SELECT size, mtime_ns, sha256 FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+            return row[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_BUFSIZE), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.add(path, digest, st)
+        return digest
+
+    def find(self, digest, size):
+        """Returns the path of a file in the tree with this content, or None."""
+        if size < DEDUP_MIN_SIZE:
+            return None
+        db = self.db()
+        rows = db.execute('SELECT path, size, mtime_ns FROM files WHERE sha256 = ?', (digest,)).fetchall()
+        for path, row_size, mtime_ns in rows:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None and (st.st_size, st.st_mtime_ns) == (row_size, mtime_ns):
+                return path
+            db.execute('DELETE FROM files WHERE path = ?', (path,))
+            db.commit()
+        # Nothing indexed with this hash: only files of the same size can
+        # match, so hash just those.
+        for path in self.files_of_size(size):
+            try:
+                if self.hash_file(path) == digest:
+                    return path
+            except OSError:
+                continue
+        return None
+
+    def files_of_size(self, size):
+        if search_index is not None and search_index.ready:
+            return [os.path.join(self.root, rel) for rel in search_index.files_of_size(size)]
+        found = []
+        stack = [self.root]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if is_upload_temp(entry.name):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False) and entry.stat().st_size == size:
+                            found.append(entry.path)
+            except OSError:
+                continue
+        return found
+
+    def commit(self, tmp_path, fn, digest, size, policy):
+        """commit_upload for a file whose content may already be in the tree.
+
+        Returns (final name, existing copy). A duplicate is stored as a
+        hardlink to the existing copy under policy 'link', or deleted with
+        a final name of None under 'refuse'.
+        """
+        existing = self.find(digest, size)
+        if existing is not None and policy == 'refuse':
+            os.unlink(tmp_path)
+            metrics.deduplicated(size)
+            return None, existing
+        if existing is not None:
+            try:
+                fn = link_unused(existing, fn)
+            except OSError:
+                existing = None
+            else:
+                os.unlink(tmp_path)
+                metrics.deduplicated(size)
+                return fn, existing
+        fn = commit_upload(tmp_path, fn)
+        if size >= DEDUP_MIN_SIZE:
+            self.add(fn, digest)
+        return fn, None
+
+
+class MultipartParser:
+    """Incremental multipart/form-data parser that streams file parts to disk.
+
+    Data is pushed in with feed() in chunks of any size; the boundary is found
+    with bytes.find over the buffered chunk, keeping only a delimiter-sized
+    tail between calls, so the cost doesn't depend on where the payload has
+    newlines. Each file part is written to a hidden temp file in the target
+    directory and renamed into place once its closing boundary arrives.
+    """
+
+    def __init__(self, boundary, directory, max_file_size=0, dedup='off'):
+        self.delimiter = b'\r\n--' + boundary
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.dedup = dedup if hash_index is not None else 'off'
+        self.hasher = None
+        # saved name -> existing file it was linked to, or (name, existing)
+        # for duplicates refused by policy.
+        self.linked = {}
+        self.refused = []
+        # A leading CRLF lets the first boundary match the same delimiter.
+        self.buf = bytearray(b'\r\n')
+        self.state = 'preamble'
+        self.out = None
+        self.tmp_path = None
+        self.filename = None
+        self.written = 0
+        self.saved = []
+
+    def feed(self, data):
+        self.buf += data
+        while True:
+            if self.state == 'preamble':
+                i = self.buf.find(self.delimiter)
+                if i < 0:
+                    del self.buf[:max(len(self.buf) - len(self.delimiter) + 1, 0)]
+                    return
+                del self.buf[:i + len(self.delimiter)]
+                self.state = 'boundary'
+            elif self.state == 'boundary':
+                if len(self.buf) < 2:
+                    return
+                if self.buf[:2] == b'--':
+                    self.state = 'done'
+                elif self.buf[:2] == b'\r\n':
+                    del self.buf[:2]
+                    self.state = 'headers'
+                else:
+                    raise UploadError("Malformed multipart boundary")
+            elif self.state == 'headers':
+                i = self.buf.find(b'\r\n\r\n')
+                if i < 0:
+                    if len(self.buf) > MAX_PART_HEADER:
+                        raise UploadError("Multipart headers too long")
+                    return
+                self.start_part(bytes(self.buf[:i]).decode('utf-8', 'replace'))
+                del self.buf[:i + 4]
+                self.state = 'body'
+            elif self.state == 'body':
+                i = self.buf.find(self.delimiter)
+                if i < 0:
+                    n = len(self.buf) - len(self.delimiter) + 1
+                    if n > 0:
+                        with memoryview(self.buf) as view:
+                            self.write(view[:n])
+                        del self.buf[:n]
+                    return
+                with memoryview(self.buf) as view:
+                    self.write(view[:i])
+                del self.buf[:i + len(self.delimiter)]
+                self.end_part()
+                self.state = 'boundary'
+            else:
+                self.buf.clear()
+                return
+
+    def start_part(self, headers):
+        fn = re.search(r'filename="((?:[^"\\]|\\.)*)"', headers, re.IGNORECASE)
+        if not fn or not fn.group(1):
+            # A form field, or a file input left empty: read past it.
+            self.out = None
+            return
+        self.filename = unique_name(self.directory, fn.group(1))
+        self.tmp_path = os.path.join(self.directory, '.upload-%s.part' % uuid.uuid4().hex)
+        try:
+            # Not mkstemp: its 0600 would carry over to the linked-in file.
+            fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError:
+            raise UploadError("No write permission")
+        self.out = os.fdopen(fd, 'wb')
+        self.written = 0
+        if self.dedup != 'off':
+            self.hasher = hashlib.sha256()
+
+    def write(self, data):
+        if self.out is None:
+            return
+        self.written += len(data)
+        if self.max_file_size and self.written > self.max_file_size:
+            raise UploadError("File '%s' exceeds the upload size limit" % escape(os.path.basename(self.filename)))
+        self.out.write(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+
+    def end_part(self):
+        if self.out is None:
+            return
+        self.out.close()
+        self.out = None
+        if self.hasher is None:
+            self.saved.append(commit_upload(self.tmp_path, self.filename))
+        else:
+            fn, existing = hash_index.commit(self.tmp_path, self.filename, self.hasher.hexdigest(), self.written, self.dedup)
+            self.hasher = None
+            if fn is None:
+                self.refused.append((self.filename, existing))
+            else:
+                self.saved.append(fn)
+                if existing is not None:
+                    self.linked[fn] = existing
+        self.tmp_path = None
+
+    def close(self):
+        """Finishes parsing and returns the paths of the saved files."""
+        if self.state != 'done':
+            self.abort()
+            raise UploadError("Unexpect Ends of data.")
+        return self.saved
+
+    def abort(self):
+        """Discards the part being written; files already committed are kept."""
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        if self.tmp_path is not None:
+            try:
+                os.unlink(self.tmp_path)
+            except OSError:
+                pass
+            self.tmp_path = None
+
+
+def is_upload_temp(name):
+    """True for the hidden files and directories uploads are staged in."""
+    return name.startswith('.upload-') and name.endswith('.part')
+
+
+# Directories known to hold resumable upload sessions, for the expiry sweep.
+session_dirs = set()
+session_dirs_lock = threading.Lock()
+
+
+def note_session_dir(directory):
+    with session_dirs_lock:
+        session_dirs.add(directory)
+
+
+class UploadSession:
+    """On-disk state of one resumable upload.
+
+    It all lives in a hidden .upload-<id>.part directory beside the final
+    file, so any worker process can take any chunk and the finished file is
+    linked into place without a copy: a preallocated 'data' file, 'meta.json'
+    with the name and size, and an empty 'start-end' marker for every chunk
+    that was written in full. Chunks go to disjoint offsets with pwrite, so
+    they can arrive in any order and in parallel.
+    """
+
+    def __init__(self, directory, upload_id):
+        if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+            raise UploadError("Unknown upload session", 404)
+        self.directory = directory
+        self.id = upload_id
+        self.path = os.path.join(directory, '.upload-%s.part' % upload_id)
+        self.data_path = os.path.join(self.path, 'data')
+        try:
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise UploadError("Unknown upload session", 404)
+        self.name = meta['name']
+        self.size = meta['size']
+        note_session_dir(directory)
+
+    @classmethod
+    def create(cls, directory, name, size):
+        name = os.path.basename(unique_name(directory, name))
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(directory, '.upload-%s.part' % upload_id)
+        try:
+            os.mkdir(path)
+        except OSError:
+            raise UploadError("No write permission", 403)
+        with open(os.path.join(path, 'data'), 'wb') as f:
+            f.truncate(size)
+        # meta.json appears last and atomically: it is what makes the id valid.
+        tmp = os.path.join(path, 'meta.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'name': name, 'size': size}, f)
+        os.rename(tmp, os.path.join(path, 'meta.json'))
+        return cls(directory, upload_id)
+
+    def idle_time(self):
+        """Seconds since the session was created or last completed a chunk."""
+        try:
+            return time.time() - os.stat(self.path).st_mtime
+        except OSError:
+            raise UploadError("Unknown upload session", 404)
+
+    def received(self):
+        """Returns the merged [start, end) byte ranges written so far."""
+        spans = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            raise UploadError("Unknown upload session", 404)
+        for name in names:
+            m = re.fullmatch(r'(\d+)-(\d+)', name)
+            if m:
+                spans.append((int(m.group(1)), int(m.group(2))))
+        spans.sort()
+        merged = []
+        for start, end in spans:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    def status(self):
+        received = self.received()
+        return {
+            'id': self.id,
+            'name': self.name,
+            'size': self.size,
+            'received': received,
+            'complete': self.size == 0 or received == [[0, self.size]],
+        }
+
+    def finish(self, dedup='off'):
+        """Links the data into place under a free name and drops the session.
+
+        Returns (final name, existing copy) like HashIndex.commit. Chunks
+        arrive out of order, so with dedup on the file is hashed here in
+        one extra read pass.
+        """
+        if not self.status()['complete']:
+            raise UploadError("Upload is incomplete", 409)
+        # Checked again: the session may predate a stricter unique_name.
+        fn = unique_name(self.directory, self.name)
+        try:
+            if dedup == 'off' or hash_index is None:
+                fn, existing = commit_upload(self.data_path, fn), None
+            else:
+                h = hashlib.sha256()
+                with open(self.data_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(COPY_BUFSIZE), b''):
+                        h.update(chunk)
+                fn, existing = hash_index.commit(self.data_path, fn, h.hexdigest(), self.size, dedup)
+        except FileNotFoundError:
+            # Another request finished it first.
+            raise UploadError("Unknown upload session", 404)
+        shutil.rmtree(self.path, ignore_errors=True)
+        return fn, existing
+
+    def abort(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ChunkWriter:
+    """Writes one PUT body into a session's data file at its offset.
+
+    Has the feed/close/abort shape of MultipartParser so both engines can
+    drive it from their request body loops.
+    """
+
+    def __init__(self, session, start, end):
+        self.session = session
+        self.start = start
+        self.end = end
+        self.offset = start
+        self.fd = os.open(session.data_path, os.O_WRONLY)
+
+    def feed(self, data):
+        if self.offset + len(data) > self.end:
+            raise UploadError("Chunk is longer than its Content-Range")
+        with memoryview(data) as view:
+            while view:
+                n = os.pwrite(self.fd, view, self.offset)
+                self.offset += n
+                view = view[n:]
+
+    def close(self):
+        """Marks the chunk as received once every byte of it is on disk."""
+        os.close(self.fd)
+        self.fd = None
+        if self.offset != self.end:
+            raise UploadError("Unexpect Ends of data.")
+        marker = os.path.join(self.session.path, '%d-%d' % (self.start, self.end))
+        os.close(os.open(marker, os.O_WRONLY | os.O_CREAT, 0o644))
+
+    def abort(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def expire_sessions(ttl):
+    """Removes resumable uploads that have received nothing for ttl seconds."""
+    with session_dirs_lock:
+        dirs = list(session_dirs)
+    cutoff = time.time() - ttl
+    for directory in dirs:
+        found = False
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not is_upload_temp(entry.name) or not entry.is_dir(follow_symlinks=False):
+                        continue
+                    found = True
+                    if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                        log.info("Expired upload session %s", entry.path)
+        except OSError:
+            pass
+        if not found:
+            with session_dirs_lock:
+                session_dirs.discard(directory)
+
+
+def run_session_sweeper(ttl):
+    while True:
+        time.sleep(min(ttl / 4, 600))
+        expire_sessions(ttl)
+
+
+# Extensions probe_media knows, and the parser for each.
+MEDIA_TYPES = {
+    '.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.gif': 'gif',
+    '.mp4': 'mp4', '.m4v': 'mp4', '.m4a': 'mp4', '.mov': 'mp4', '.3gp': 'mp4',
+    '.mkv': 'mkv', '.webm': 'mkv', '.mka': 'mkv',
+    '.mp3': 'mp3', '.flac': 'flac', '.wav': 'wav', '.ogg': 'ogg', '.oga': 'ogg', '.opus': 'ogg',
+}
+# How much of a file's start, and of its end for Ogg, a probe reads at once.
+PROBE_HEAD = 16 * 1024
+PROBE_TAIL = 16 * 1024
+# Files a background probe task handles in one database transaction.
+PROBE_BATCH = 256
+# Scheduling priority increment of the probing processes.
+PROBE_NICE = 19
+# MediaIndex's scheduler thread shares the GIL with requests: it pauses
+# this long after every SCHEDULE_SLICE entries it checks, and between
+# PROBE_BATCH submissions.
+SCHEDULE_SLICE = 1000
+SCHEDULE_PAUSE = 0.01
+
+
+def media_type(name):
+    """The MEDIA_TYPES parser for a file name, or None.
+
+    Cheaper than os.path.splitext; listings call it once per entry.
+    """
+    return MEDIA_TYPES.get(name[name.rfind('.'):].lower())
+
+
+def probe_media(path):
+    """Reads width/height/duration from a media file's headers.
+
+    Only the first and last few KB are read, plus the few bytes of each box
+    or segment header on the way to the interesting one. Returns a dict,
+    empty when the format isn't recognised or the file is damaged.
+    """
+    kind = media_type(os.path.basename(path))
+    if kind is None:
+        return {}
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            info = globals()['probe_' + kind](f, size)
+    except (OSError, ValueError, IndexError, struct.error):
+        return {}
+    if 'duration' in info:
+        info['duration'] = round(info['duration'], 3)
+    return info
+
+
+def probe_png(f, size):
+    head = f.read(24)
+    if head[:8] != b'\x89PNG\r\n\x1a\n' or head[12:16] != b'IHDR':
+        return {}
+    width, height = struct.unpack('>II', head[16:24])
+    return {'width': width, 'height': height}
+
+
+def probe_gif(f, size):
+    head = f.read(10)
+    if head[:6] not in (b'GIF87a', b'GIF89a'):
+        return {}
+    width, height = struct.unpack('<HH', head[6:10])
+    return {'width': width, 'height': height}
+
+
+def probe_jpeg(f, size):
+    """Walks the marker segments, seeking past each, to the first SOFn."""
+    if f.read(2) != b'\xff\xd8':
+        return {}
+    while True:
+        b = f.read(1)
+        while b and b != b'\xff':
+            b = f.read(1)
+        while b == b'\xff':
+            b = f.read(1)
+        if not b:
+            return {}
+        marker = b[0]
+        if marker in (0x01, 0xd8) or 0xd0 <= marker <= 0xd7:
+            continue
+        if marker in (0xd9, 0xda):
+            # End of image or start of scan before any frame header.
+            return {}
+        length = struct.unpack('>H', f.read(2))[0]
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack('>xHH', f.read(5))
+            return {'width': width, 'height': height}
+        f.seek(length - 2, 1)
+
+
+def mp4_boxes(f, start, end):
+    """Yields (type, payload start, box end) for the ISO BMFF boxes in [start, end)."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        box_size, kind = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if box_size == 1:
+            box_size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif box_size == 0:
+            box_size = end - pos
+        if box_size < header:
+            return
+        yield kind, pos + header, min(pos + box_size, end)
+        pos += box_size
+
+
+def probe_mp4(f, size):
+    """Duration from moov/mvhd and the first visual track's size from tkhd."""
+    info = {}
+    for kind, start, end in mp4_boxes(f, 0, size):
+        if kind != b'moov':
+            continue
+        for kind, start, end in mp4_boxes(f, start, end):
+            if kind == b'mvhd':
+                f.seek(start)
+                data = f.read(32)
+                if data[0] == 1:
+                    timescale, duration = struct.unpack('>IQ', data[20:32])
+                else:
+                    timescale, duration = struct.unpack('>II', data[12:20])
+                if timescale and duration not in (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF):
+                    info['duration'] = duration / timescale
+            elif kind == b'trak' and 'width' not in info:
+                for kind, start, end in mp4_boxes(f, start, end):
+                    if kind == b'tkhd' and end - start >= 84:
+                        # Width and height close the box as 16.16 fixed point.
+                        f.seek(end - 8)
+                        width, height = struct.unpack('>II', f.read(8))
+                        if width and height:
+                            info['width'] = width >> 16
+                            info['height'] = height >> 16
+        break
+    return info
+
+
+def ebml_vint(buf, pos, mask=True):
+    """Reads an EBML variable-length integer; returns (value, length)."""
+    first = buf[pos]
+    length = 1
+    bit = 0x80
+    while not first & bit:
+        bit >>= 1
+        length += 1
+        if length > 8:
+            raise ValueError("bad EBML integer")
+    value = first & (bit - 1) if mask else first
+    for b in buf[pos + 1:pos + length]:
+        value = value << 8 | b
+    return value, length
+
+
+def ebml_elements(buf, pos, end):
+    """Yields (id, data start, data end) for the EBML elements in buf[pos:end]."""
+    while pos < end:
+        eid, n = ebml_vint(buf, pos, mask=False)
+        pos += n
+        size, n = ebml_vint(buf, pos)
+        pos += n
+        if size == (1 << (7 * n)) - 1:
+            # Unknown size: runs to the end of the parent.
+            size = end - pos
+        yield eid, pos, min(pos + size, end)
+        pos += size
+
+
+def probe_mkv(f, size):
+    """Segment Info and Tracks normally sit in the first few KB, before any Cluster."""
+    buf = f.read(PROBE_HEAD * 4)
+    info = {}
+    for eid, start, end in ebml_elements(buf, 0, len(buf)):
+        if eid != 0x18538067:
+            continue
+        scale = 1000000
+        for eid, start, end in ebml_elements(buf, start, end):
+            if eid == 0x1549A966:
+                duration = None
+                for eid, s, e in ebml_elements(buf, start, end):
+                    if eid == 0x2AD7B1:
+                        scale = int.from_bytes(buf[s:e], 'big')
+                    elif eid == 0x4489:
+                        duration = struct.unpack('>f' if e - s == 4 else '>d', buf[s:e])[0]
+                if duration:
+                    info['duration'] = duration * scale / 1e9
+            elif eid == 0x1654AE6B:
+                for eid, s, e in ebml_elements(buf, start, end):
+                    if eid != 0xAE or 'width' in info:
+                        continue
+                    for eid, s, e in ebml_elements(buf, s, e):
+                        if eid != 0xE0:
+                            continue
+                        for eid, vs, ve in ebml_elements(buf, s, e):
+                            if eid == 0xB0:
+                                info['width'] = int.from_bytes(buf[vs:ve], 'big')
+                            elif eid == 0xBA:
+                                info['height'] = int.from_bytes(buf[vs:ve], 'big')
+            elif eid == 0x1F43B675:
+                break
+        break
+    return info
+
+
+MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def probe_mp3(f, size):
+    """Duration from a Xing/Info or VBRI frame count, else from the bitrate."""
+    head = f.read(10)
+    start = 0
+    if head[:3] == b'ID3':
+        start = 10 + (head[6] << 21 | head[7] << 14 | head[8] << 7 | head[9])
+        if head[5] & 0x10:
+            start += 10
+    f.seek(start)
+    buf = f.read(PROBE_HEAD)
+    i = -1
+    while True:
+        # Frame sync: eleven set bits.
+        i = buf.find(b'\xff', i + 1)
+        if i < 0 or i > len(buf) - 4:
+            return {}
+        if buf[i + 1] & 0xE0 != 0xE0:
+            continue
+        version_bits = buf[i + 1] >> 3 & 3
+        layer = 4 - (buf[i + 1] >> 1 & 3)
+        bitrate_index = buf[i + 2] >> 4
+        rate_index = buf[i + 2] >> 2 & 3
+        if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+            continue
+        version = 1 if version_bits == 3 else 2
+        rate = MP3_RATES[version_bits][rate_index]
+        bitrate = MP3_BITRATES[(version, layer)][bitrate_index] * 1000
+        samples = 384 if layer == 1 else 1152 if layer == 2 or version == 1 else 576
+        mono = buf[i + 3] >> 6 == 3
+        side = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+        xing = i + 4 + side
+        if buf[xing:xing + 4] in (b'Xing', b'Info') and buf[xing + 7] & 1:
+            frames = struct.unpack('>I', buf[xing + 8:xing + 12])[0]
+            return {'duration': frames * samples / rate}
+        if buf[i + 36:i + 40] == b'VBRI':
+            frames = struct.unpack('>I', buf[i + 50:i + 54])[0]
+            return {'duration': frames * samples / rate}
+        audio = size - start - i
+        f.seek(size - 128)
+        if f.read(3) == b'TAG':
+            audio -= 128
+        return {'duration': audio * 8 / bitrate}
+
+
+def probe_flac(f, size):
+    head = f.read(26)
+    if head[:4] != b'fLaC' or head[4] & 0x7F != 0:
+        return {}
+    packed = int.from_bytes(head[18:26], 'big')
+    rate = packed >> 44
+    total = packed & ((1 << 36) - 1)
+    return {'duration': total / rate} if rate and total else {}
+
+
+def probe_wav(f, size):
+    head = f.read(12)
+    if head[:4] != b'RIFF' or head[8:12] != b'WAVE':
+        return {}
+    pos = 12
+    byte_rate = None
+    while pos + 8 <= size:
+        f.seek(pos)
+        kind, length = struct.unpack('<4sI', f.read(8))
+        if kind == b'fmt ':
+            byte_rate = struct.unpack('<I', f.read(12)[8:12])[0]
+        elif kind == b'data' and byte_rate:
+            return {'duration': min(length, size - pos - 8) / byte_rate}
+        pos += 8 + length + (length & 1)
+    return {}
+
+
+def probe_ogg(f, size):
+    """Sample rate from the first packet, length from the last page's granule."""
+    head = f.read(PROBE_HEAD)
+    if head[:4] != b'OggS':
+        return {}
+    packet = 27 + head[26]
+    skip = 0
+    if head[packet:packet + 7] == b'\x01vorbis':
+        rate = struct.unpack('<I', head[packet + 12:packet + 16])[0]
+    elif head[packet:packet + 8] == b'OpusHead':
+        rate = 48000
+        skip = struct.unpack('<H', head[packet + 10:packet + 12])[0]
+    else:
+        return {}
+    f.seek(max(size - PROBE_TAIL, 0))
+    tail = f.read(PROBE_TAIL)
+    last = tail.rfind(b'OggS')
+    if last < 0 or not rate:
+        return {}
+    granule = struct.unpack('<q', tail[last + 6:last + 14])[0]
+    return {'duration': max(granule - skip, 0) / rate}
+
+
+def format_media(info):
+    """Short display form of probe_media's result, e.g. '1920x1080, 1:02:03'."""
+    if not info:
+        return ''
+    parts = []
+    if 'width' in info:
+        parts.append('%dx%d' % (info['width'], info['height']))
+    if 'duration' in info:
+        minutes, seconds = divmod(int(info['duration']), 60)
+        hours, minutes = divmod(minutes, 60)
+        parts.append('%d:%02d:%02d' % (hours, minutes, seconds) if hours else '%d:%02d' % (minutes, seconds))
+    return ', '.join(parts)
+
+
+def media_digest(name, entry):
+    """64-bit hash of one MediaIndex entry; a directory's version XORs them."""
+    size, mtime, info = entry
+    if not info:
+        # Nothing to show either way.
+        return 0
+    data = json.dumps([name, size, mtime, info], sort_keys=True).encode('ascii')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+class MediaIndex(SQLiteStore):
+    """Media metadata for listings and search results, probed in the background.
+
+    Pages only read what this process holds in memory: they hand misses,
+    and directories it hasn't loaded from SQLite yet, to a scheduler thread
+    and render without them. The scheduler loads directories and queues
+    misses on a small process pool, which probes and records them without
+    holding this process's GIL. Results persist in SQLite keyed by
+    directory and name, valid while the size and mtime match, and each
+    process keeps recently listed directories in memory.
+
+    A directory's version, which invalidates its cached listing and is part
+    of its ETag, is a digest of the metadata known for it, so processes that
+    know the same agree on it. It moves once queued probes are done, or every
+    settle seconds meanwhile: a big directory being probed isn't re-rendered
+    after every file.
+    """
+
+    schema = (
+        # dir and name are os.fsencode()d: file names needn't be valid UTF-8.
+        'CREATE TABLE IF NOT EXISTS media (dir BLOB, name BLOB, size INTEGER, mtime REAL, meta TEXT, '
+        'PRIMARY KEY (dir, name))',
+    )
+    max_dirs = 1024
+    max_pending = 1000000
+    max_jobs = 256
+    settle = 5.0
+
+    def __init__(self, db_path, workers=2):
+        SQLiteStore.__init__(self, db_path)
+        # directory -> [version, {name: (size, mtime, info)}, last version change, current digest]
+        self.dirs = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending = set()
+        # directory -> number of its files in pending
+        self.waiting = {}
+        # Directories queued for loading from the database.
+        self.loading = set()
+        self.closed = False
+        # forkserver: forking this threaded process directly could copy held
+        # locks; spawn where there is no forkserver (Windows). Niced where
+        # possible, so probing yields the CPU to requests.
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        if hasattr(os, 'nice'):
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method),
+                                                initializer=os.nice, initargs=(PROBE_NICE,))
+        else:
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method))
+        # Start the pool now rather than in the middle of the first page
+        # with a miss: its processes import this module un-niced.
+        for _ in range(workers):
+            self.executor.submit(os.getpid)
+        # (directory, None) to load it, or (root, entries) with misses.
+        self.jobs = queue.Queue(self.max_jobs)
+        threading.Thread(target=self.run_scheduler, name='media-scheduler', daemon=True).start()
+
+    def cached(self, directory):
+        """The in-memory item for directory, or None; never touches the database."""
+        with self.lock:
+            item = self.dirs.get(directory)
+            if item is not None:
+                self.dirs.move_to_end(directory)
+            return item
+
+    def known(self, directory):
+        """The item for directory, loading it from the database if need be."""
+        item = self.cached(directory)
+        if item is not None:
+            return item
+        rows = self.db().execute('SELECT name, size, mtime, meta FROM media WHERE dir = ?',
+                                 (os.fsencode(directory),)).fetchall()
+        entries = {}
+        digest = 0
+        for name, size, mtime, meta in rows:
+            name = os.fsdecode(name)
+            entries[name] = (size, mtime, json.loads(meta))
+            digest ^= media_digest(name, entries[name])
+        with self.lock:
+            item = self.dirs.setdefault(directory, [digest, entries, time.monotonic(), digest])
+            while len(self.dirs) > self.max_dirs:
+                self.dirs.popitem(last=False)
+        return item
+
+    def version(self, directory):
+        """Changes with the metadata known for directory; 0 until it is loaded."""
+        item = self.cached(directory)
+        if item is not None:
+            return item[0]
+        with self.lock:
+            if directory in self.loading:
+                return 0
+            self.loading.add(directory)
+        self.submit_job(directory, None)
+        return 0
+
+    def lookup(self, root, entries):
+        """Returns {linkname: info} for entries already probed, queueing the rest.
+
+        entries are scan_directory tuples whose linknames are relative to root.
+        """
+        found = {}
+        dirs = {}
+        missed = False
+        for linkname, _, size, mtime in entries:
+            head, _, name = linkname.rpartition('/')
+            if media_type(name) is None:
+                continue
+            if head not in dirs:
+                item = self.cached(os.path.join(root, head) if head else root)
+                dirs[head] = item[1] if item is not None else {}
+            item = dirs[head].get(name)
+            if item is not None and item[0] == size and item[1] == mtime:
+                if item[2]:
+                    found[linkname] = item[2]
+            else:
+                missed = True
+        if missed:
+            self.submit_job(root, entries)
+        return found
+
+    def submit_job(self, root, entries):
+        try:
+            self.jobs.put_nowait((root, entries))
+        except queue.Full:
+            # Best effort: the next page showing these entries asks again.
+            if entries is None:
+                with self.lock:
+                    self.loading.discard(root)
+
+    def run_scheduler(self):
+        while not self.closed:
+            root, entries = self.jobs.get()
+            try:
+                if entries is None:
+                    self.known(root)
+                    with self.lock:
+                        self.loading.discard(root)
+                else:
+                    self.schedule(root, entries)
+            except sqlite3.Error:
+                log.exception("Media lookup in %s failed", root)
+
+    def schedule(self, root, entries):
+        """Queues the entries lookup couldn't answer on the pool, PROBE_BATCH to a task."""
+        dirs = {}
+        misses = {}
+        for i, (linkname, _, size, mtime) in enumerate(entries):
+            if i % SCHEDULE_SLICE == SCHEDULE_SLICE - 1:
+                time.sleep(SCHEDULE_PAUSE)
+            head, _, name = linkname.rpartition('/')
+            if media_type(name) is None:
+                continue
+            if head not in dirs:
+                directory = os.path.join(root, head) if head else root
+                dirs[head] = (directory, self.known(directory)[1])
+            directory, known = dirs[head]
+            item = known.get(name)
+            if item is None or item[0] != size or item[1] != mtime:
+                misses.setdefault(directory, []).append((name, size, mtime))
+        for directory, files in misses.items():
+            self.queue_probes(directory, files)
+
+    def queue_probes(self, directory, files):
+        batch = []
+        with self.lock:
+            room = self.max_pending - len(self.pending)
+            for file in files:
+                if len(batch) >= room:
+                    break
+                if (directory, file[0]) not in self.pending:
+                    self.pending.add((directory, file[0]))
+                    batch.append(file)
+            if batch:
+                self.waiting[directory] = self.waiting.get(directory, 0) + len(batch)
+        for i in range(0, len(batch), PROBE_BATCH):
+            if i:
+                time.sleep(SCHEDULE_PAUSE)
+            files = batch[i:i + PROBE_BATCH]
+            try:
+                future = self.executor.submit(probe_files, self.db_path, directory, files)
+            except RuntimeError as e:
+                # Shut down, or a pool process died (BrokenProcessPool).
+                log.warning("Can't queue media probes: %s", e)
+                self.probed(directory, batch[i:], None)
+                return
+            future.add_done_callback(functools.partial(self.probed, directory, files))
+
+    def probed(self, directory, files, future):
+        """Takes a probe_files result in, on the pool's management thread."""
+        probed = []
+        if future is not None and not future.cancelled():
+            try:
+                probed = future.result()
+            except Exception:
+                # Whatever went wrong, the files must leave pending below.
+                log.exception("Media probe in %s failed", directory)
+        with self.lock:
+            item = self.dirs.get(directory)
+            if item is not None:
+                for name, entry in probed:
+                    if name in item[1]:
+                        item[3] ^= media_digest(name, item[1][name])
+                    item[1][name] = entry
+                    item[3] ^= media_digest(name, entry)
+            for name, _, _ in files:
+                self.pending.discard((directory, name))
+            waiting = self.waiting.pop(directory) - len(files)
+            if waiting:
+                self.waiting[directory] = waiting
+            now = time.monotonic()
+            if item is not None and item[3] != item[0] and (not waiting or now - item[2] >= self.settle):
+                item[0] = item[3]
+                item[2] = now
+
+    def close(self):
+        """Drops queued probes and waits for the running ones, so no pool process outlives us."""
+        self.closed = True
+        self.executor.shutdown(cancel_futures=True)
+
+
+# Per pool process: db_path -> SQLiteStore
+probe_stores = {}
+
+
+def probe_files(db_path, directory, files):
+    """Runs in a MediaIndex pool process: probes and records (name, size, mtime) files.
+
+    Returns [(name, (size, mtime, info))] for MediaIndex.probed.
+    """
+    store = probe_stores.get(db_path)
+    if store is None:
+        store = probe_stores[db_path] = SQLiteStore(db_path)
+    db = store.db()
+    key = os.fsencode(directory)
+    probed = []
+    rows = []
+    for name, size, mtime in files:
+        row = db.execute('SELECT meta FROM media WHERE dir = ? AND name = ? AND size = ? AND mtime = ?',
+                         (key, os.fsencode(name), size, mtime)).fetchone()
+        if row is not None:
+            # Another worker process probed it already.
+            info = json.loads(row[0])
+        else:
+            info = probe_media(os.path.join(directory, name))
+            rows.append((key, os.fsencode(name), size, mtime, json.dumps(info)))
+        probed.append((name, (size, mtime, info)))
+    db.executemany('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?)', rows)
+    db.commit()
+    return probed
+
+
+search_index = None
+hash_index = None
+media_index = None
+
+
+class CountingWriter:
+    """Wraps a handler's wfile, counting the bytes written through it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
 
 class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Streamed responses go out as several small writes; with Nagle on, a
+    # kept-alive client's delayed ACK stalls each one by ~40ms.
+    disable_nagle_algorithm = True
+    # Per-operation socket timeout, and how long an idle keep-alive
+    # connection may wait for its next request.
+    timeout = 60
+    keepalive_timeout = 5
+    use_sendfile = True
+    ranges = None
+    chunked = False
+    metrics_enabled = True
+    upload_session_ttl = 24 * 60 * 60
+    dedup = 'off'
+    cache_control = 'no-cache'
+    listing_cache_control = 'no-cache'
+    search_page_size = 100
+    max_upload_size = 0
+    max_request_size = 0
+    compress = True
+    # Files up to this size are compressed whole and kept in compressed_cache.
+    compress_cache_max_file = 4 * 1024 * 1024
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.wfile = CountingWriter(self.wfile)
+        self.buckets, self.allowance = shaper.open(self.client_address[0]) if shaper is not None else ((), None)
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        finally:
+            if self.buckets:
+                shaper.close(self.client_address[0])
+
+    def handle_one_request(self):
+        self.route = 'other'
+        self.status = None
+        self.upload_received = 0
+        self.command = None
+        start = time.perf_counter()
+        sent = self.wfile.count
+        BaseHTTPRequestHandler.handle_one_request(self)
+        if self.command is not None:
+            self.record_request(start, self.wfile.count - sent)
+
+    def record_request(self, start, sent):
+        """Feeds metrics and the access log once a request is done."""
+        elapsed = time.perf_counter() - start
+        metrics.observe(self.route, self.status, elapsed, sent)
+        if access_log.isEnabledFor(logging.INFO):
+            access_log.info('%s "%s" %s %d %.1fms', self.address_string(), self.requestline,
+                            self.status, sent, elapsed * 1000, extra={'fields': {
+                                'client': self.address_string(), 'method': self.command,
+                                'path': self.path, 'status': self.status, 'route': self.route,
+                                'bytes': sent, 'ms': round(elapsed * 1000, 3)}})
+
+    def log_request(self, code='-', size='-'):
+        # Logged by record_request once the body has gone out.
+        self.status = getattr(code, 'value', code)
+
+    def log_error(self, format, *args):
+        if log.isEnabledFor(logging.WARNING):
+            log.warning("%s %s", self.address_string(), format % args)
+
+    def log_message(self, format, *args):
+        if log.isEnabledFor(logging.INFO):
+            log.info("%s %s", self.address_string(), format % args)
+
+    def handle(self):
+        """Serves requests on the connection until either side closes it.
+
+        Between requests the socket waits only keepalive_timeout for the next
+        one, so idle clients give their worker back quickly. Pipelined
+        requests are already buffered and are served straight away.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and not getattr(self.server, 'draining', False):
+            try:
+                self.connection.settimeout(self.keepalive_timeout)
+                if not self.rfile.peek(1):
+                    break
+                self.connection.settimeout(self.timeout)
+            except OSError:
+                break
+            self.handle_one_request()
+
     def do_GET(self):
+        """Serve a GET request."""
+        fd = self.route_get()
+        if fd:
+            self.send_body(fd)
+            fd.close()
+
+    def route_get(self):
+        """Sends the headers for a GET or HEAD and returns the body to follow."""
+        self.ranges = None
+        if self.headers.get('Content-Length', '0') != '0' or 'Transfer-Encoding' in self.headers:
+            # The unread body would be taken for the next pipelined request.
+            self.close_connection = True
+        if self.metrics_enabled and self.path.split('?', 1)[0] == '/metrics':
+            self.route = 'metrics'
+            return self.send_metrics()
+        if self.path.split('?', 1)[0] == '/dedup':
+            self.route = 'upload'
+            return self.send_lookup()
         if self.path.startswith('/search?q='):
+            self.route = 'search'
             query = self.path.split('=')[1]
-            print(f"Search query: {query}")
+            log.debug("Search query: %s", query)
             path = translate_path(self.path)
-            fd = self.filter(path)
-            if fd:
-                shutil.copyfileobj(fd, self.wfile)
-                fd.close()
-            
-        else:    
-            """Serve a GET request."""
-            fd = self.send_head()
-            if fd:
-                shutil.copyfileobj(fd, self.wfile)
-                fd.close()
+            return self.filter(path)
+        if self.session_query() is not None:
+            return self.session_request()
+        return self.send_head()
+
+    def send_metrics(self):
+        body = metrics.render({'listing': listing_cache, 'compressed': compressed_cache, 'scan': scan_cache}, search_index)
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        return BytesIO(body)
+
+    def copyfile(self, source, outputfile, offset=0, count=None):
+        """Copies source to outputfile, using the kernel sendfile path for regular files.
+
+        With count set, only count bytes starting at offset are sent; the
+        bytes before offset are never read.
+        """
+        if self.buckets and outputfile is self.wfile:
+            return self.copyfile_shaped(source, offset, count)
+        if self.can_sendfile(source):
+            outputfile.flush()
+            sent = self.connection.sendfile(source, offset, count)
+            if outputfile is self.wfile:
+                self.wfile.count += sent
+            return
+        if offset:
+            source.seek(offset)
+        if count is None:
+            shutil.copyfileobj(source, outputfile, COPY_BUFSIZE)
+            return
+        while count > 0:
+            buf = source.read(min(COPY_BUFSIZE, count))
+            if not buf:
+                break
+            outputfile.write(buf)
+            count -= len(buf)
+
+    def copyfile_shaped(self, source, offset, count):
+        """copyfile in SHAPE_CHUNK slices, each paced by send_delay.
+
+        Only the bytes actually sent are charged: count is bounded by the
+        file's size, and reads are paced once they have returned data.
+        """
+        if count is None:
+            count = file_remaining(source, offset)
+        sendfile = self.can_sendfile(source)
+        if sendfile:
+            self.wfile.flush()
+        elif offset:
+            source.seek(offset)
+        while count is None or count > 0:
+            size = SHAPE_CHUNK if count is None else min(SHAPE_CHUNK, count)
+            if sendfile:
+                self.pace(size)
+                n = self.connection.sendfile(source, offset, size)
+                self.wfile.count += n
+                offset += n
+            else:
+                buf = source.read(size)
+                n = len(buf)
+                if n:
+                    self.pace(n)
+                    self.wfile.write(buf)
+            if not n:
+                break
+            if count is not None:
+                count -= n
+
+    def send_delay(self, size):
+        """Charges size bytes to the connection's rate limits.
+
+        Returns how long to wait before sending them. Bulk downloads (file
+        and zip bodies once the client's interactive allowance is spent)
+        wait out any debt; listings, search, HEAD and the occasional small
+        file never wait, and the bytes they take push the bulk transfers
+        back instead. The allowance belongs to the client, not the request,
+        so splitting a download into Range requests doesn't renew it.
+        """
+        wait = max(bucket.reserve(size) for bucket in self.buckets)
+        if self.command != 'GET' or self.route not in ('file', 'zip') or self.allowance.take(size):
+            return 0
+        return wait
+
+    def pace(self, size):
+        if self.buckets:
+            delay = self.send_delay(size)
+            if delay:
+                metrics.throttled(delay)
+                time.sleep(delay)
+
+    def send_body(self, f):
+        """Sends the body opened by send_head, honouring any ranges it selected."""
+        if not hasattr(f, 'read'):
+            self.send_stream(f)
+        elif not self.ranges:
+            self.copyfile(f, self.wfile)
+        elif len(self.ranges) == 1:
+            start, end, _ = self.ranges[0]
+            self.copyfile(f, self.wfile, start, end - start + 1)
+        else:
+            for start, end, part_header in self.ranges:
+                self.wfile.write(part_header)
+                self.copyfile(f, self.wfile, start, end - start + 1)
+                self.wfile.write(b'\r\n')
+            self.wfile.write(self.range_trailer)
+
+    def start_stream(self):
+        """Sends the framing headers for a body whose length isn't known yet.
+
+        HTTP/1.1 exchanges get chunked encoding; anything older is delimited
+        by closing the connection.
+        """
+        self.chunked = self.request_version == 'HTTP/1.1' and self.protocol_version >= 'HTTP/1.1'
+        if self.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+            self.send_header("Connection", "close")
+
+    def send_stream(self, chunks):
+        """Writes the pieces of a body started with start_stream."""
+        for chunk in chunks:
+            if not chunk:
+                continue
+            self.pace(len(chunk))
+            if self.chunked:
+                self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+            else:
+                self.wfile.write(chunk)
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def can_sendfile(self, source):
+        # TLS-wrapped sockets and in-memory pages have no fd the kernel can
+        # splice, so they take the buffered path.
+        if not self.use_sendfile or not hasattr(os, 'sendfile'):
+            return False
+        if type(self.connection) is not socket.socket:
+            return False
+        try:
+            return stat.S_ISREG(os.fstat(source.fileno()).st_mode)
+        except (AttributeError, OSError, ValueError):
+            return False
 
     def filter(self, path):
-        print(path)
+        log.debug("Listing %s", path)
         query_params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
         search_query = query_params.get("q", [""])[0] 
-
-        
         try:
-            path = path[:-7]
-            print(path)
-            list_dir = os.listdir(path)
-            list_dir = [f for f in list_dir if search_query.lower() in f.lower()]
-        except os.error:
-            self.send_error(404, "No permission to list directory")
-            return None
-        # list_dir.sort(key=lambda a: a.lower())
-        f = BytesIO()
-        display_path = escape(unquote(self.path))
-        f.write(b'<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
-        f.write(b'<html>\n<head>\n')
-        f.write(b'<title>Directory listing for %s</title>\n' % display_path.encode('utf-8'))
-        f.write(b'<style>\n')
-        f.write(b'body { font-family: Arial, sans-serif; margin: 0; padding: 0; background-color: #F2F2F2; }\n')
-        f.write(b'img { display: block; width: 60%; margin-left: auto; margin-right: auto;}\n')
-        f.write(b'.container { max-width: 800px; margin: 0 auto; padding: 20px; background-color: #FFF; box-shadow: 0 0 10px rgba(0, 0, 0, 0.3); }\n')
-        f.write(b'h1 { text-align: center; margin-bottom: 20px; }\n')
-        f.write(b'form { display: flex; flex-direction: column; align-items: center; margin-bottom: 20px; }\n')
-        f.write(b'input[type="file"] { margin-bottom: 10px; }\n')
-        f.write(b'input[type="submit"] { background-color: #13274D; color: #FFF; padding: 10px; border: none; border-radius: 5px; cursor: pointer; transition: background-color 0.2s ease-in-out; }\n')
-        f.write(b'input[type="submit"]:hover { background-color: #3E8E41; }\n')
-        f.write(b'table { border-collapse: collapse; width: 100%; margin-bottom: 20px; }\n')
-        f.write(b'th, td { padding: 10px; text-align: left; border-bottom: 1px solid #ddd; }\n')
-        f.write(b'th { background-color: #13274D; color: #FFF; }\n')
-        f.write(b'a { color: #000; text-decoration: none; }\n')
-        f.write(b'a:hover { text-decoration: underline; }\n')
-        f.write(b'</style>\n')
-        f.write(b'</head>\n')
-        #f.write(b'<div style=\"text-align: center;\">\n')
-        f.write(b'<img width=\"400\" src=\"https://images2.imgbox.com/46/aa/qG7wrGvc_o.png\">\n')
-        f.write(b'<h1>Share files</h1>')
-        #f.write(b'<\div>\n')
-        f.write(b"<hr>\n")
-        f.write(b"<h1>Upload File</h1>\n")
-        f.write(b"<form ENCTYPE=\"multipart/form-data\" method=\"post\" style=\"margin-bottom: 1em;\">\n")
-        f.write(b"<input name=\"file\" type=\"file\" style=\"margin-right: 0.5em;\" />\n")
-        f.write(b"<input type=\"submit\" value=\"Upload File\" class=\"btn btn-primary\" />\n")
-        f.write(b"</form>\n")
-        f.write(b"<form action=\"/search\" method=\"get\">\n")
-        f.write(b"<label for=\"search\">Search:</label>\n")
-        f.write(b"<input type=\"search\" id=\"search\" name=\"q\" placeholder=\"Search...\">\n")
-        f.write(b"<button type=\"submit\">Go</button>\n")
-        f.write(b"</form>\n")
-        #f.write(b'<img width=\"400\" src=\"https://www.hubspot.com/hubfs/image-hubspot-centering-css.jpeg\">\n')
-        # f.write(b"<html>\n<title>Directory listing for %s</title>\n" % display_path.encode('utf-8'))
-        # f.write(b"<body>\n<h2>Directory listing for %s</h2>\n" % display_path.encode('utf-8'))
-        # f.write(b"<hr>\n")
-        # f.write(b"<form ENCTYPE=\"multipart/form-data\" method=\"post\">")
-        # f.write(b"<input name=\"file\" type=\"file\"/>")
-        # f.write(b"<input type=\"submit\" value=\"upload\"/></form>\n")
-        f.write(b"<hr>\n<ul>\n")
-        new_list = []
-        new_list_1 = []
-        # f.write(b"<h1>Directories</h1>\n")
-        for name in list_dir:
-            fullname = os.path.join(path, name)
-            size = os.stat(fullname).st_size
-            modified_time = os.stat(fullname).st_mtime
-            display_name = linkname = name
-            # Append / for directories or @ for symbolic links
-            wat = False
-            if os.path.isdir(fullname):
-                display_name = name + "/"
-                linkname = name + "/"
-                wat = True
-            if os.path.islink(fullname):
-                display_name = name + "@"
-                wat = True
-                # Note: a link to a directory displays with @ and links with /
-            if wat:
-                # f.write(b'<li><a href="%s">%s</a>\n' % (quote(linkname).encode('utf-8'), escape(display_name).encode('utf-8')))
-                new_list_1.append((linkname, display_name, size, modified_time))
-            else:
-                new_list.append((linkname, display_name, size, modified_time))
-        # f.write(b"<h1>Files</h1>\n")
-        # for linkname, display_name in new_list:
-        #     f.write(b'<li><a href="%s">%s</a>\n' % (quote(linkname).encode('utf-8'), escape(display_name).encode('utf-8')))
-        f.write(b'<hr>\n<h2>Directories:</h2>\n')
-        f.write(b'<table style="width:100%" align="center">\n')
-        f.write(b'<tr>\n<th>Name</th>\n<th>Size</th>\n<th>Last Modified</th>\n</tr>\n')
-        for linkname, display_name, size, modified_time in new_list_1:
-            print(linkname, display_name, size, modified_time)
-            f.write(b'<tr>\n')
-            f.write(b'<td><a href="%s">%s</a></td>\n' % (quote(linkname).encode('utf-8'), escape(display_name).encode('utf-8')))
-            f.write(b'<td>%s</td>\n' % format_size(size).encode('utf-8'))
-            f.write(b'<td>%s</td>\n' % format_date(modified_time).encode('utf-8'))
-            f.write(b'</tr>\n')
-        f.write(b'</table>\n')
-        f.write(b'<hr>\n<h2>Files:</h2>\n')
-        f.write(b'<table style="width:100%" align="center">\n')
-        f.write(b'<tr>\n<th>Name</th>\n<th>Size</th>\n<th>Last Modified</th>\n</tr>\n')
-        for linkname, display_name, size, modified_time in new_list:
-            print(linkname, display_name, size, modified_time)
-            f.write(b'<tr>\n')
-            f.write(b'<td><a href="%s">%s</a></td>\n' % (quote(linkname).encode('utf-8'), escape(display_name).encode('utf-8')))
-            f.write(b'<td>%s</td>\n' % format_size(size).encode('utf-8'))
-            f.write(b'<td>%s</td>\n' % format_date(modified_time).encode('utf-8'))
-            f.write(b'</tr>\n')
-        f.write(b'</table>\n')
+            page = max(int(query_params.get("page", ["1"])[0]), 1)
+        except ValueError:
+            page = 1
+        nav = b''
 
-        f.write(b"</ul>\n<hr>\n</body>\n</html>\n")
-        length = f.tell()
-        f.seek(0)
+        root = os.getcwd()
+        if search_index is not None and search_index.ready:
+            root = search_index.root
+            per_page = self.search_page_size
+            total, matches = search_index.search(search_query, (page - 1) * per_page, per_page)
+            dirs = []
+            files = []
+            for rel_path, _, is_dir, size, modified_time in matches:
+                if is_dir:
+                    dirs.append((rel_path + "/", rel_path + "/", size, modified_time))
+                else:
+                    files.append((rel_path, rel_path, size, modified_time))
+            pages = max((total + per_page - 1) // per_page, 1)
+            nav = b'<p>%d results, page %d of %d' % (total, page, pages)
+            for label, target in ((b'previous', page - 1), (b'next', page + 1)):
+                if 1 <= target <= pages:
+                    link = '/search?' + urllib.parse.urlencode({'q': search_query, 'page': target})
+                    nav += b' <a href="%s">%s</a>' % (escape(link).encode('utf-8'), label)
+            nav += b'</p>\n'
+        else:
+            # The index is still being built; search the one directory meanwhile.
+            try:
+                path = root = path[:-7]
+                log.debug("Listing %s", path)
+                dirs, files = scan_directory(path, lambda name: search_query.lower() in name.lower())
+            except os.error:
+                self.send_error(404, "No permission to list directory")
+                return None
+        media = media_index.lookup(root, files) if media_index is not None else None
+        body = render_listing(escape(unquote(self.path)), dirs, files, nav, media)
+        encoding = choose_encoding(self.headers.get('Accept-Encoding')) if self.compress else None
+        if encoding:
+            body = compress_bytes(body, encoding)
+        f = BytesIO(body)
         self.send_response(200)
         self.send_header("Content-type", "text/html;charset=utf-8")
-        self.send_header("Content-Length", str(length))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if self.compress:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
         return f
 
-        
-
     def do_HEAD(self):
 
-        fd = self.send_head()
+        fd = self.route_get()
         if fd:
             fd.close()
 
     def do_POST(self):
 
+        self.route = 'upload'
+        if self.session_query() is not None:
+            f = self.session_request()
+            if f:
+                self.copyfile(f, self.wfile)
+                f.close()
+            return
         r, info = self.deal_post_data()
-        print(r, info, "addresss: ", self.client_address)
+        f = self.send_upload_result(r, info)
+        self.copyfile(f, self.wfile)
+        f.close()
+
+    def send_upload_result(self, r, info):
+        metrics.upload(r, self.upload_received)
+        log.info("Upload %s from %s: %s", "succeeded" if r else "failed", self.client_address[0], info)
         f = BytesIO()
         f.write(b'<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
         f.write(b"<html>\n<title>Upload Result Page</title>\n")
@@ -207,190 +2483,506 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
         self.send_header("Content-type", "text/html;charset=utf-8")
         self.send_header("Content-Length", str(length))
         self.end_headers()
-        if f:
-            shutil.copyfileobj(f, self.wfile)
-            f.close()
+        return f
 
     def deal_post_data(self):
-        print(self.headers)
-        boundary = self.headers["Content-Type"].split("=")[1].encode('utf-8')
-        remain_bytes = int(self.headers['content-length'])
-        line = self.rfile.readline()
-        remain_bytes -= len(line)
-        if boundary not in line:
-            return False, "Content NOT begin with boundary"
-        line = self.rfile.readline()
-        remain_bytes -= len(line)
-        fn = re.findall(r'Content-Disposition.*name="file"; filename="(.*)"', line.decode('utf-8'))
-        if not fn:
-            return False, "Can't find file name"
+        parser = None
+        try:
+            parser, remain_bytes = self.start_upload()
+            while remain_bytes > 0:
+                chunk = self.rfile.read(min(UPLOAD_CHUNK, remain_bytes))
+                if not chunk:
+                    break
+                remain_bytes -= len(chunk)
+                self.upload_received += len(chunk)
+                parser.feed(chunk)
+            return self.finish_upload(parser)
+        except (UploadError, OSError) as e:
+            return self.upload_failed(parser, e)
+
+    def start_upload(self):
+        """Validates the upload headers and returns (parser, body length)."""
+        log.debug("Upload headers: %s", self.headers)
+        boundary = self.headers.get_param('boundary')
+        if self.headers.get_content_type() != 'multipart/form-data' or not boundary:
+            raise UploadError("Content NOT begin with boundary")
+        try:
+            remain_bytes = int(self.headers['content-length'])
+        except (TypeError, ValueError):
+            raise UploadError("Missing Content-Length")
+        if self.max_request_size and remain_bytes > self.max_request_size:
+            raise UploadError("Upload exceeds the request size limit")
         path = translate_path(self.path)
-        fn = os.path.join(path, fn[0])
-        while os.path.exists(fn):
-            fn += "_"
-        line = self.rfile.readline()
-        remain_bytes -= len(line)
-        line = self.rfile.readline()
-        remain_bytes -= len(line)
+        return MultipartParser(boundary.encode('latin-1'), path, self.max_upload_size, self.dedup), remain_bytes
+
+    def finish_upload(self, parser):
+        saved = parser.close()
+        lines = []
+        for fn in saved:
+            line = "File '%s' upload success!" % escape(fn)
+            if fn in parser.linked:
+                line += " Same content as '%s', stored as a hardlink." % escape(parser.linked[fn])
+            lines.append(line)
+        for fn, existing in parser.refused:
+            lines.append("File '%s' is already on the server as '%s', not stored." % (escape(fn), escape(existing)))
+        if not lines:
+            return False, "Can't find file name"
+        return bool(saved), "<br>".join(lines)
+
+    def upload_failed(self, parser, error):
+        """Cleans up a failed upload; the unread body rules out keep-alive."""
+        if parser is not None:
+            parser.abort()
+        self.close_connection = True
+        if isinstance(error, UploadError):
+            return False, str(error)
+        if isinstance(error, TimeoutError):
+            return False, "Upload timed out"
+        return False, "No write permission"
+
+    def do_PUT(self):
+        self.route = 'upload'
+        chunk = None
         try:
-            out = open(fn, 'wb')
-        except IOError:
-            return False, "No write permission"
-
-        pre_line = self.rfile.readline()
-        remain_bytes -= len(pre_line)
-        while remain_bytes > 0:
-            line = self.rfile.readline()
-            remain_bytes -= len(line)
-            if boundary in line:
-                pre_line = pre_line[0:-1]
-                if pre_line.endswith(b'\r'):
-                    pre_line = pre_line[0:-1]
-                out.write(pre_line)
-                out.close()
-                return True, "File '%s' upload success!" % fn
-            else:
-                out.write(pre_line)
-                pre_line = line
-        return False, "Unexpect Ends of data."
+            chunk, remain_bytes = self.start_chunk()
+            while remain_bytes > 0:
+                data = self.rfile.read(min(UPLOAD_CHUNK, remain_bytes))
+                if not data:
+                    break
+                remain_bytes -= len(data)
+                self.upload_received += len(data)
+                chunk.feed(data)
+            self.finish_chunk(chunk)
+        except (UploadError, OSError) as e:
+            self.chunk_failed(chunk, e)
+
+    def do_DELETE(self):
+        f = self.session_request()
+        if f:
+            self.copyfile(f, self.wfile)
+            f.close()
+
+    def session_query(self):
+        """Returns the parsed query of a resumable upload request, else None."""
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        return query if 'upload' in query else None
+
+    def session_request(self):
+        """Handles the bodiless resumable upload calls on a directory URL.
+
+        POST ?upload=new&name=N&size=S creates a session; GET/HEAD
+        ?upload=ID reports the received ranges; POST ?upload=ID assembles
+        the file; DELETE ?upload=ID abandons it.
+        """
+        self.route = 'upload'
+        if self.headers.get('Content-Length', '0') != '0' or 'Transfer-Encoding' in self.headers:
+            self.close_connection = True
+        query = self.session_query()
+        if query is None:
+            # A DELETE on a plain URL; a POST without one is a multipart upload.
+            self.send_error(405, "%s needs an upload session" % self.command)
+            return None
+        upload_id = query['upload'][0]
+        directory = translate_path(self.path)
+        url = urllib.parse.urlsplit(self.path).path
+        try:
+            if not os.path.isdir(directory):
+                raise UploadError("File not found", 404)
+            if self.command == 'POST' and upload_id == 'new':
+                try:
+                    name = query['name'][0]
+                    size = int(query['size'][0])
+                except (KeyError, ValueError):
+                    raise UploadError("Need name and size")
+                name = os.path.basename(unique_name(directory, name))
+                if size < 0:
+                    raise UploadError("Need name and size")
+                if self.max_upload_size and size > self.max_upload_size:
+                    raise UploadError("File '%s' exceeds the upload size limit" % name, 413)
+                if 'sha256' in query and self.dedup != 'off' and hash_index is not None:
+                    # The client already knows the content: if the tree has
+                    # it too, there is nothing to transfer.
+                    existing = hash_index.find(query['sha256'][0].lower(), size)
+                    if existing is not None:
+                        body = self.store_duplicate(directory, url, name, size, existing)
+                        if body is not None:
+                            return body
+                session = UploadSession.create(directory, name, size)
+                log.info("Upload session %s for %s from %s", session.id, name, self.client_address[0])
+                return self.send_json(201, session.status(), location=url + '?upload=' + session.id)
+            session = self.open_session(directory, upload_id)
+            if self.command in ('GET', 'HEAD'):
+                return self.send_json(200, session.status())
+            if self.command == 'DELETE':
+                session.abort()
+                return self.send_json(200, {'id': session.id})
+            fn, existing = session.finish(self.dedup)
+            if fn is None:
+                raise UploadError("File is already on the server as %s" % self.file_url(existing), 409)
+            metrics.upload(True, 0)
+            log.info("Upload succeeded from %s: %s", self.client_address[0], fn)
+            name = os.path.basename(fn)
+            doc = {'name': name, 'size': session.size}
+            if existing is not None:
+                doc['duplicate_of'] = self.file_url(existing)
+            return self.send_json(201, doc, location=url + quote(name))
+        except UploadError as e:
+            self.send_error(e.status, str(e))
+        except OSError:
+            self.send_error(500, "No write permission")
+        return None
+
+    def store_duplicate(self, directory, url, name, size, existing):
+        """Answers an upload whose content is already in the tree, by policy.
+
+        Returns None if existing can't be linked (EMLINK, EXDEV, ...): the
+        content then has to be uploaded after all.
+        """
+        if self.dedup == 'refuse':
+            metrics.deduplicated(size)
+            raise UploadError("File is already on the server as %s" % self.file_url(existing), 409)
+        try:
+            fn = link_unused(existing, unique_name(directory, name))
+        except OSError as e:
+            log.warning("Can't link upload to existing %s: %s", existing, e)
+            return None
+        metrics.deduplicated(size)
+        metrics.upload(True, 0)
+        log.info("Upload from %s linked %s to existing %s", self.client_address[0], fn, existing)
+        name = os.path.basename(fn)
+        doc = {'name': name, 'size': size, 'duplicate_of': self.file_url(existing)}
+        return self.send_json(201, doc, location=url + quote(name))
+
+    def file_url(self, path):
+        return '/' + quote(os.path.relpath(path, os.getcwd()).replace(os.sep, '/'))
+
+    def send_lookup(self):
+        """Answers /dedup?sha256=H&size=N with where that content already is."""
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        try:
+            digest = query['sha256'][0].lower()
+            size = int(query['size'][0])
+        except (KeyError, ValueError):
+            self.send_error(400, "Need sha256 and size")
+            return None
+        existing = None
+        if self.dedup != 'off' and hash_index is not None:
+            existing = hash_index.find(digest, size)
+        doc = {'found': existing is not None}
+        if existing is not None:
+            doc['url'] = self.file_url(existing)
+        return self.send_json(200, doc)
+
+    def open_session(self, directory, upload_id):
+        session = UploadSession(directory, upload_id)
+        if session.idle_time() > self.upload_session_ttl:
+            session.abort()
+            raise UploadError("Unknown upload session", 404)
+        return session
+
+    def start_chunk(self):
+        """Checks a chunk PUT against its session; returns (writer, body length)."""
+        query = self.session_query()
+        if query is None:
+            raise UploadError("PUT needs an upload session", 405)
+        session = self.open_session(translate_path(self.path), query['upload'][0])
+        m = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+|\*)', self.headers.get('Content-Range', ''))
+        if not m:
+            raise UploadError("Missing Content-Range")
+        start, last = int(m.group(1)), int(m.group(2))
+        if last < start or last >= session.size or m.group(3) not in ('*', str(session.size)):
+            raise UploadError("Content-Range outside the upload", 416)
+        try:
+            length = int(self.headers['content-length'])
+        except (TypeError, ValueError):
+            raise UploadError("Missing Content-Length", 411)
+        if length != last - start + 1:
+            raise UploadError("Content-Length doesn't match Content-Range")
+        if self.max_request_size and length > self.max_request_size:
+            raise UploadError("Upload exceeds the request size limit", 413)
+        return ChunkWriter(session, start, last + 1), length
+
+    def finish_chunk(self, chunk):
+        chunk.close()
+        metrics.chunk(self.upload_received)
+        self.send_response(204)
+        self.end_headers()
+
+    def chunk_failed(self, chunk, error):
+        """Reports a failed chunk; like a failed upload, it drops the connection."""
+        if chunk is not None:
+            chunk.abort()
+        metrics.chunk(self.upload_received)
+        self.close_connection = True
+        if isinstance(error, UploadError):
+            code, message = error.status, str(error)
+        elif isinstance(error, TimeoutError):
+            code, message = 408, "Upload timed out"
+        else:
+            code, message = 500, "No write permission"
+        try:
+            self.send_error(code, message)
+        except OSError:
+            # A dropped connection is the usual reason a chunk comes up short.
+            pass
+
+    def send_json(self, code, doc, location=None):
+        body = json.dumps(doc).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        if location is not None:
+            self.send_header("Location", location)
+        self.end_headers()
+        return BytesIO(body)
 
     def send_head(self):
         
+        self.ranges = None
         path = translate_path(self.path)
         if os.path.isdir(path):
-            if not self.path.endswith('/'):
+            parts = urllib.parse.urlsplit(self.path)
+            if not parts.path.endswith('/'):
                 self.send_response(301)
-                self.send_header("Location", self.path + "/")
+                self.send_header("Location", urllib.parse.urlunsplit(parts._replace(path=parts.path + '/')))
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
+            if urllib.parse.parse_qs(parts.query).get('format') == ['zip']:
+                self.route = 'zip'
+                return self.send_zip(path)
             for index in "index.html", "index.htm":
                 index = os.path.join(path, index)
                 if os.path.exists(index):
                     path = index
                     break
             else:
+                self.route = 'listing'
                 return self.list_directory(path)
+        self.route = 'file'
         content_type = self.guess_type(path)
         try:
             f = open(path, 'rb')
         except IOError:
             self.send_error(404, "File not found")
             return None
-        self.send_response(200)
-        self.send_header("Content-type", content_type)
         fs = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(fs[6]))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        compressible = self.compress and is_compressible(content_type)
+        encoding = choose_encoding(self.headers.get('Accept-Encoding')) if compressible else None
+        if encoding:
+            return self.send_compressed(path, f, fs, content_type, encoding)
+        return self.send_file(f, fs, content_type, vary=compressible)
+
+    def send_file(self, f, fs, content_type, encoding=None, vary=False):
+        """Sends the headers for an open file, handling validators and ranges."""
+        size = fs.st_size
+        etag = make_etag(fs)
+        if self.not_modified(etag, fs.st_mtime):
+            f.close()
+            self.send_not_modified(etag, fs.st_mtime, self.cache_control)
+            return None
+        ranges = None
+        if self.if_range_matches(etag, fs.st_mtime):
+            ranges = parse_range(self.headers.get('Range'), size)
+        if ranges is not None and not ranges:
+            f.close()
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if not ranges:
+            self.send_response(200)
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-Length", str(size))
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_response(206)
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.ranges = [(start, end, b'')]
+        else:
+            boundary = uuid.uuid4().hex
+            self.ranges = []
+            length = 0
+            for start, end in ranges:
+                part_header = ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                               % (boundary, content_type, start, end, size)).encode('latin-1')
+                self.ranges.append((start, end, part_header))
+                length += len(part_header) + end - start + 1 + 2
+            self.range_trailer = ('--%s--\r\n' % boundary).encode('latin-1')
+            length += len(self.range_trailer)
+            self.send_response(206)
+            self.send_header("Content-type", "multipart/byteranges; boundary=" + boundary)
+            self.send_header("Content-Length", str(length))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if vary:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_validators(etag, fs.st_mtime, self.cache_control)
         self.end_headers()
         return f
 
+    def send_compressed(self, path, f, fs, content_type, encoding):
+        """Sends a compressible file in the negotiated content-coding.
+
+        A precompressed .br/.gz sidecar at least as new as the file is served
+        as-is (ranges included). Otherwise the file is compressed on the fly:
+        small files go through compressed_cache, larger ones are streamed.
+        """
+        sidecar = path + ('.br' if encoding == 'br' else '.gz')
+        try:
+            side = open(sidecar, 'rb')
+        except IOError:
+            side = None
+        if side is not None:
+            side_stat = os.fstat(side.fileno())
+            if stat.S_ISREG(side_stat.st_mode) and side_stat.st_mtime_ns >= fs.st_mtime_ns:
+                f.close()
+                return self.send_file(side, side_stat, content_type, encoding, vary=True)
+            side.close()
+
+        etag = encoded_etag(make_etag(fs), encoding)
+        if self.not_modified(etag, fs.st_mtime):
+            f.close()
+            self.send_not_modified(etag, fs.st_mtime, self.cache_control)
+            return None
+        key = (path, encoding)
+        version = (fs.st_ino, fs.st_mtime_ns, fs.st_size)
+        body = compressed_cache.get(key, version)
+        if body is None and fs.st_size <= self.compress_cache_max_file:
+            body = compress_bytes(f.read(), encoding)
+            compressed_cache.put(key, version, body)
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_validators(etag, fs.st_mtime, self.cache_control)
+        if body is not None:
+            f.close()
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return BytesIO(body)
+        self.start_stream()
+        self.end_headers()
+        return compress_stream(iter_file(f), encoding)
+
+    def if_range_matches(self, etag, mtime):
+        """Checks If-Range; a range request for a changed file gets the whole file."""
+        value = self.headers.get('If-Range')
+        if not value:
+            return True
+        value = value.strip()
+        if value.startswith('"') or value.startswith('W/'):
+            # If-Range needs a strong match, so weak tags never qualify.
+            return value == etag and not etag.startswith('W/')
+        date = parse_http_date(value)
+        return date is not None and int(date) == int(mtime)
+
+    def not_modified(self, etag, mtime):
+        """Evaluates If-None-Match, or If-Modified-Since when no tags were sent."""
+        if self.command not in ('GET', 'HEAD'):
+            return False
+        tags = self.headers.get('If-None-Match')
+        if tags is not None:
+            return etag_matches(tags, etag)
+        since = self.headers.get('If-Modified-Since')
+        if since is None:
+            return False
+        date = parse_http_date(since)
+        return date is not None and int(mtime) <= date
+
+    def send_validators(self, etag, mtime, cache_control):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(mtime))
+        if cache_control:
+            self.send_header("Cache-Control", cache_control)
+
+    def send_not_modified(self, etag, mtime, cache_control):
+        self.send_response(304)
+        self.send_validators(etag, mtime, cache_control)
+        self.end_headers()
+
+    def send_zip(self, path):
+        """Starts a streamed ZIP download of the directory at path."""
+        try:
+            os.scandir(path).close()
+        except OSError:
+            self.send_error(404, "No permission to list directory")
+            return None
+        name = os.path.basename(path.rstrip(os.sep)) or 'share'
+        self.send_response(200)
+        self.send_header("Content-type", "application/zip")
+        self.send_header("Content-Disposition", "attachment; filename*=UTF-8''%s.zip" % quote(name))
+        self.send_header("Cache-Control", "no-store")
+        self.start_stream()
+        self.end_headers()
+        return iter_zip(path, lambda name: is_compressible(self.guess_type(name)))
+
     def list_directory(self, path):
-        print(path)
-       
+        log.debug("Listing %s", path)
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
         try:
-            list_dir = os.listdir(path)
+            fmt, sort, order, offset, limit = parse_listing_options(query)
+        except ValueError:
+            self.send_error(400, "Bad listing parameters")
+            return None
+
+        try:
+            dir_stat = os.stat(path)
+            # Weak: the directory mtime moves when entries are added, removed
+            # or renamed, but not when a file is rewritten in place.
+            etag = make_etag(dir_stat, weak=True)
+            version = dir_stat.st_mtime_ns
+            if media_index is not None:
+                # Newly probed metadata changes the page as well.
+                media_version = media_index.version(path)
+                etag = etag[:-1] + '-%x"' % media_version
+                version = (version, media_version)
+            if self.not_modified(etag, dir_stat.st_mtime):
+                self.send_not_modified(etag, dir_stat.st_mtime, self.listing_cache_control)
+                return None
+            url_path = unquote(self.path.split('?', 1)[0])
+            encoding = choose_encoding(self.headers.get('Accept-Encoding')) if self.compress else None
+            key = (path, url_path, fmt, sort, order, offset, limit, encoding)
+            body = listing_cache.get(key, version)
+            if body is None:
+                dirs, files = sorted_scan(path, sort, dir_stat.st_mtime_ns)
         except os.error:
             self.send_error(404, "No permission to list directory")
             return None
-        # list_dir.sort(key=lambda a: a.lower())
-        f = BytesIO()
-        display_path = escape(unquote(self.path))
-        f.write(b'<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
-        f.write(b'<html>\n<head>\n')
-        f.write(b'<title>Directory listing for %s</title>\n' % display_path.encode('utf-8'))
-        f.write(b'<style>\n')
-        f.write(b'body { font-family: Arial, sans-serif; margin: 0; padding: 0; background-color: #F2F2F2; }\n')
-        f.write(b'.container { max-width: 800px; margin: 0 auto; padding: 20px; background-color: #FFF; box-shadow: 0 0 10px rgba(0, 0, 0, 0.3); }\n')
-        f.write(b'img { display: block; width: 60%; margin-left: auto; margin-right: auto;}\n')
-        f.write(b'h1 { text-align: center; margin-bottom: 20px; }\n')
-        f.write(b'form { display: flex; flex-direction: column; align-items: center; margin-bottom: 20px; }\n')
-        f.write(b'input[type="file"] { margin-bottom: 10px; }\n')
-        f.write(b'input[type="submit"] { background-color: #13274D; color: #FFF; padding: 10px; border: none; border-radius: 5px; cursor: pointer; transition: background-color 0.2s ease-in-out; }\n')
-        f.write(b'input[type="submit"]:hover { background-color: #3E8E41; }\n')
-        f.write(b'table { border-collapse: collapse; width: 100%; margin-bottom: 20px; }\n')
-        f.write(b'th, td { padding: 10px; text-align: left; border-bottom: 1px solid #ddd; }\n')
-        f.write(b'th { background-color: #13274D; color: #FFF; }\n')
-        f.write(b'a { color: #000; text-decoration: none; }\n')
-        f.write(b'a:hover { text-decoration: underline; }\n')
-        f.write(b'</style>\n')
-        f.write(b'</head>\n')
-        f.write(b'<img width=\"400\" src=\"https://images2.imgbox.com/46/aa/qG7wrGvc_o.png\">\n')
-        f.write(b'<h1>Share files</h1>\n')
-        f.write(b"<hr>\n")
-        f.write(b"<h1>Upload File</h1>\n")
-        f.write(b"<form ENCTYPE=\"multipart/form-data\" method=\"post\" style=\"margin-bottom: 1em;\">\n")
-        f.write(b"<input name=\"file\" type=\"file\" style=\"margin-right: 0.5em;\" />\n")
-        f.write(b"<input type=\"submit\" value=\"Upload File\" class=\"btn btn-primary\" />\n")
-        f.write(b"</form>\n")
-        f.write(b"<form action=\"/search\" method=\"get\">\n")
-        f.write(b"<label for=\"search\">Search:</label>\n")
-        f.write(b"<input type=\"search\" id=\"search\" name=\"q\" placeholder=\"Search...\">\n")
-        f.write(b"<button type=\"submit\">Go</button>\n")
-        f.write(b"</form>\n")
-        # f.write(b"<html>\n<title>Directory listing for %s</title>\n" % display_path.encode('utf-8'))
-        # f.write(b"<body>\n<h2>Directory listing for %s</h2>\n" % display_path.encode('utf-8'))
-        # f.write(b"<hr>\n")
-        # f.write(b"<form ENCTYPE=\"multipart/form-data\" method=\"post\">")
-        # f.write(b"<input name=\"file\" type=\"file\"/>")
-        # f.write(b"<input type=\"submit\" value=\"upload\"/></form>\n")
-        f.write(b"<hr>\n<ul>\n")
-        new_list = []
-        new_list_1 = []
-        # f.write(b"<h1>Directories</h1>\n")
-        for name in list_dir:
-            fullname = os.path.join(path, name)
-            size = os.stat(fullname).st_size
-            modified_time = os.stat(fullname).st_mtime
-            display_name = linkname = name
-            # Append / for directories or @ for symbolic links
-            wat = False
-            if os.path.isdir(fullname):
-                display_name = name + "/"
-                linkname = name + "/"
-                wat = True
-            if os.path.islink(fullname):
-                display_name = name + "@"
-                wat = True
-                # Note: a link to a directory displays with @ and links with /
-            if wat:
-                # f.write(b'<li><a href="%s">%s</a>\n' % (quote(linkname).encode('utf-8'), escape(display_name).encode('utf-8')))
-                new_list_1.append((linkname, display_name, size, modified_time))
-            else:
-                new_list.append((linkname, display_name, size, modified_time))
-        # f.write(b"<h1>Files</h1>\n")
-        # for linkname, display_name in new_list:
-        #     f.write(b'<li><a href="%s">%s</a>\n' % (quote(linkname).encode('utf-8'), escape(display_name).encode('utf-8')))
-        f.write(b'<hr>\n<h2>Directories:</h2>\n')
-        f.write(b'<table style="width:100%" align="center">\n')
-        f.write(b'<tr>\n<th>Name</th>\n<th>Size</th>\n<th>Last Modified</th>\n</tr>\n')
-        for linkname, display_name, size, modified_time in new_list_1:
-            print(linkname, display_name, size, modified_time)
-            f.write(b'<tr>\n')
-            f.write(b'<td><a href="%s">%s</a></td>\n' % (quote(linkname).encode('utf-8'), escape(display_name).encode('utf-8')))
-            f.write(b'<td>%s</td>\n' % format_size(size).encode('utf-8'))
-            f.write(b'<td>%s</td>\n' % format_date(modified_time).encode('utf-8'))
-            f.write(b'</tr>\n')
-        f.write(b'</table>\n')
-        f.write(b'<hr>\n<h2>Files:</h2>\n')
-        f.write(b'<table style="width:100%" align="center">\n')
-        f.write(b'<tr>\n<th>Name</th>\n<th>Size</th>\n<th>Last Modified</th>\n</tr>\n')
-        for linkname, display_name, size, modified_time in new_list:
-            print(linkname, display_name, size, modified_time)
-            f.write(b'<tr>\n')
-            f.write(b'<td><a href="%s">%s</a></td>\n' % (quote(linkname).encode('utf-8'), escape(display_name).encode('utf-8')))
-            f.write(b'<td>%s</td>\n' % format_size(size).encode('utf-8'))
-            f.write(b'<td>%s</td>\n' % format_date(modified_time).encode('utf-8'))
-            f.write(b'</tr>\n')
-        f.write(b'</table>\n')
-
-        f.write(b"</ul>\n<hr>\n</body>\n</html>\n")
-        length = f.tell()
-        f.seek(0)
         self.send_response(200)
-        self.send_header("Content-type", "text/html;charset=utf-8")
-        self.send_header("Content-Length", str(length))
+        if fmt == 'json':
+            self.send_header("Content-type", "application/json")
+        else:
+            self.send_header("Content-type", "text/html;charset=utf-8")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if self.compress:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_validators(etag, dir_stat.st_mtime, self.listing_cache_control)
+        if body is not None:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return BytesIO(body)
+
+        total = len(dirs) + len(files)
+        page_dirs, page_files = paginate(dirs, files, order, offset, limit)
+        media = media_index.lookup(path, page_files) if media_index is not None else None
+        if fmt == 'json':
+            chunks = iter_json_listing(url_path, page_dirs, page_files, total, offset, limit, media)
+        else:
+            nav = b'<p><a href="?format=zip">Download this folder as zip</a></p>\n'
+            nav += pagination_nav(query, total, offset, limit)
+            chunks = iter_listing(escape(url_path), page_dirs, page_files, nav, media)
+        if encoding:
+            chunks = compress_stream(chunks, encoding)
+        self.start_stream()
         self.end_headers()
-        return f
+        return cached_stream(chunks, key, version)
 
     def guess_type(self, path):
     
@@ -415,6 +3007,544 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
     })
 
 
+# Sent, without reading the request, to connections over the limits.
+REJECT_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\n'
+                   b'Content-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n')
+
+
+class ConnectionLimiter:
+    """Counts open connections, overall and per client IP; 0 means no limit."""
+
+    def __init__(self, max_connections=0, max_per_ip=0):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.total = 0
+        self.per_ip = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, ip):
+        with self.lock:
+            if self.max_connections and self.total >= self.max_connections:
+                return False
+            count = self.per_ip.get(ip, 0)
+            if self.max_per_ip and count >= self.max_per_ip:
+                return False
+            self.total += 1
+            self.per_ip[ip] = count + 1
+            return True
+
+    def release(self, ip):
+        with self.lock:
+            self.total -= 1
+            count = self.per_ip[ip] - 1
+            if count:
+                self.per_ip[ip] = count
+            else:
+                del self.per_ip[ip]
+
+
+class TokenBucket:
+    """Refills at rate bytes/s up to burst bytes; reservations may go into debt."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(rate / 4, 2 * SHAPE_CHUNK) if burst is None else burst
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """Takes size tokens and returns the seconds until the bucket is out of debt.
+
+        Callers that wait that long before sending are served in the order
+        they reserved, so bulk senders sharing a bucket take turns.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def take(self, size):
+        """Takes size tokens if the bucket holds that many; never goes into debt."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < size:
+                return False
+            self.tokens -= size
+            return True
+
+
+class BandwidthShaper:
+    """Global, per client IP and per connection token buckets; 0 means no limit.
+
+    Each client IP also has an interactive allowance, see send_delay. It and
+    the IP's bucket outlive the IP's last connection by INTERACTIVE_WINDOW,
+    so reconnecting doesn't renew them.
+    """
+
+    def __init__(self, rate=0, per_ip=0, per_connection=0):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.per_ip = per_ip
+        self.per_connection = per_connection
+        # ip -> [bucket or None, open connections, interactive allowance]
+        self.ips = {}
+        # ip -> when its last connection closed, oldest first
+        self.idle = OrderedDict()
+        self.lock = threading.Lock()
+
+    def open(self, ip):
+        """Returns (buckets, allowance) for a new connection from ip."""
+        buckets = []
+        if self.bucket is not None:
+            buckets.append(self.bucket)
+        with self.lock:
+            now = time.monotonic()
+            while self.idle:
+                idle_ip, since = next(iter(self.idle.items()))
+                if now - since < INTERACTIVE_WINDOW:
+                    break
+                del self.idle[idle_ip]
+                del self.ips[idle_ip]
+            self.idle.pop(ip, None)
+            item = self.ips.get(ip)
+            if item is None:
+                item = self.ips[ip] = [TokenBucket(self.per_ip) if self.per_ip else None, 0,
+                                       TokenBucket(INTERACTIVE_BYTES / INTERACTIVE_WINDOW, INTERACTIVE_BYTES)]
+            item[1] += 1
+        if item[0] is not None:
+            buckets.append(item[0])
+        if self.per_connection:
+            buckets.append(TokenBucket(self.per_connection))
+        return buckets, item[2]
+
+    def close(self, ip):
+        with self.lock:
+            item = self.ips[ip]
+            item[1] -= 1
+            if not item[1]:
+                self.idle[ip] = time.monotonic()
+
+
+shaper = None
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that serves connections on a fixed set of worker threads.
+
+    Accepted connections wait in a bounded queue for a free worker; when the
+    queue is full, or a ConnectionLimiter says no, the client gets a 503
+    immediately instead of a new thread.
+    """
+
+    request_queue_size = 128
+
+    def __init__(self, server_address, RequestHandlerClass, threads=64, queue_size=64, limiter=None, sock=None):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate=sock is None)
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+        self.queue = queue.Queue(queue_size)
+        self.limiter = limiter or ConnectionLimiter()
+        self.draining = False
+        self.active = 0
+        self.idle = threading.Condition()
+        for _ in range(threads):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def begin_shutdown(self):
+        """Stops accepting; safe to call from a signal handler."""
+        self.draining = True
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def drain(self, timeout):
+        """Waits for queued and in-flight connections after serve_forever returns."""
+        self.server_close()
+        deadline = time.monotonic() + timeout
+        with self.idle:
+            while self.active or not self.queue.empty():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.idle.wait(remaining)
+
+    def process_request(self, request, client_address):
+        if not self.limiter.acquire(client_address[0]):
+            self.reject(request)
+            return
+        try:
+            self.queue.put_nowait((request, client_address))
+        except queue.Full:
+            self.limiter.release(client_address[0])
+            self.reject(request)
+
+    def worker(self):
+        while True:
+            request, client_address = self.queue.get()
+            with self.idle:
+                self.active += 1
+            metrics.connection(1)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.limiter.release(client_address[0])
+                self.shutdown_request(request)
+                metrics.connection(-1)
+                with self.idle:
+                    self.active -= 1
+                    self.idle.notify_all()
+
+    def reject(self, request):
+        try:
+            request.sendall(REJECT_RESPONSE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+
+class AsyncHTTPServer:
+    """asyncio engine that serves the routes of a SimpleHTTPRequestHandler.
+
+    One event loop owns every connection, so idle and slow clients cost a
+    socket and a coroutine rather than a thread. The route code itself
+    (stat, open, listing render, multipart writes) runs unchanged on a small
+    thread pool against a handler whose output is captured in memory; the
+    loop then transmits the body, handing regular files to loop.sendfile.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, max_workers=None, limiter=None, sock=None):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.limiter = limiter or ConnectionLimiter()
+        self.server = None
+        self.socket = sock
+        self.draining = False
+        self.active = 0
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.socket is not None:
+            self.server = await asyncio.start_server(
+                self.handle_connection, sock=self.socket, limit=MAX_REQUEST_HEAD)
+        else:
+            host, port = self.server_address
+            self.server = await asyncio.start_server(
+                self.handle_connection, host, port, limit=MAX_REQUEST_HEAD, backlog=1024)
+        self.socket = self.server.sockets[0]
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            # begin_shutdown closed the listener.
+            pass
+
+    def begin_shutdown(self):
+        """Stops accepting; safe to call from a signal handler."""
+        self.loop.call_soon_threadsafe(self.close_listener)
+
+    def close_listener(self):
+        self.draining = True
+        self.server.close()
+
+    async def drain(self, timeout):
+        """Waits for open connections to finish their current requests."""
+        deadline = time.monotonic() + timeout
+        while self.active and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    async def handle_connection(self, reader, writer):
+        ip = writer.get_extra_info('peername')[0]
+        if not self.limiter.acquire(ip):
+            writer.write(REJECT_RESPONSE)
+            writer.close()
+            return
+        # asyncio only sets TCP_NODELAY itself on listeners it created.
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        timeout = self.RequestHandlerClass.timeout
+        self.active += 1
+        metrics.connection(1)
+        buckets, allowance = shaper.open(ip) if shaper is not None else ((), None)
+        try:
+            while await self.handle_one_request(reader, writer, timeout, buckets, allowance) and not self.draining:
+                timeout = self.RequestHandlerClass.keepalive_timeout
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.active -= 1
+            metrics.connection(-1)
+            self.limiter.release(ip)
+            if buckets:
+                shaper.close(ip)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def make_handler(self, head, writer, buckets=(), allowance=None):
+        """Builds a handler that parses head and writes its response to memory."""
+        h = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        h.server = self
+        h.request = h.connection = None
+        h.client_address = writer.get_extra_info('peername')
+        h.rfile = BytesIO(head)
+        h.wfile = BytesIO()
+        h.raw_requestline = h.rfile.readline(65537)
+        h.requestline = ''
+        h.request_version = h.default_request_version
+        h.command = None
+        h.close_connection = True
+        h.route = 'other'
+        h.status = None
+        h.upload_received = 0
+        h.bytes_sent = 0
+        h.buckets = buckets
+        h.allowance = allowance
+        return h
+
+    def write(self, h, writer, data):
+        h.bytes_sent += len(data)
+        writer.write(data)
+
+    async def drained(self, h, writer):
+        """writer.drain(), failing after --timeout like a stalled socket write."""
+        await asyncio.wait_for(writer.drain(), h.timeout)
+
+    async def read_body(self, h, reader, size):
+        """reader.read(size), failing after --timeout like a stalled socket read."""
+        return await asyncio.wait_for(reader.read(size), h.timeout)
+
+    async def flush(self, h, writer):
+        """Sends whatever the handler has written so far."""
+        data = h.wfile.getvalue()
+        if data:
+            self.write(h, writer, data)
+            h.wfile.seek(0)
+            h.wfile.truncate()
+        await self.drained(h, writer)
+
+    async def handle_one_request(self, reader, writer, timeout, buckets=(), allowance=None):
+        """Serves one request; returns True if the connection stays open."""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        except asyncio.IncompleteReadError:
+            return False
+        except asyncio.LimitOverrunError:
+            h = self.make_handler(b'', writer)
+            h.send_error(431)
+            await self.flush(h, writer)
+            return False
+        start = time.perf_counter()
+        h = self.make_handler(head, writer, buckets, allowance)
+        if not h.parse_request():
+            await self.flush(h, writer)
+            return False
+        try:
+            await self.dispatch(h, reader, writer)
+        finally:
+            h.record_request(start, h.bytes_sent)
+        return not h.close_connection
+
+    async def dispatch(self, h, reader, writer):
+        # parse_request may have queued a 100 Continue.
+        await self.flush(h, writer)
+        if h.command in ('GET', 'HEAD'):
+            body = await self.run(h.route_get)
+            await self.flush(h, writer)
+            if body:
+                try:
+                    if h.command == 'GET':
+                        await self.send_body(h, body, writer)
+                finally:
+                    body.close()
+        elif h.command == 'POST' and h.session_query() is None:
+            await self.handle_post(h, reader, writer)
+        elif h.command in ('POST', 'DELETE'):
+            body = await self.run(h.session_request)
+            await self.flush(h, writer)
+            if body:
+                await self.send_bytes(h, writer, body.getvalue())
+        elif h.command == 'PUT':
+            await self.handle_put(h, reader, writer)
+        else:
+            h.send_error(501, "Unsupported method (%r)" % h.command)
+            await self.flush(h, writer)
+
+    async def handle_post(self, h, reader, writer):
+        h.route = 'upload'
+        parser = None
+        try:
+            parser, remain_bytes = await self.run(h.start_upload)
+            while remain_bytes > 0:
+                chunk = await self.read_body(h, reader, min(UPLOAD_CHUNK, remain_bytes))
+                if not chunk:
+                    break
+                remain_bytes -= len(chunk)
+                h.upload_received += len(chunk)
+                await self.run(parser.feed, chunk)
+            r, info = await self.run(h.finish_upload, parser)
+        except (UploadError, OSError, asyncio.TimeoutError) as e:
+            r, info = h.upload_failed(parser, e)
+        body = h.send_upload_result(r, info)
+        await self.flush(h, writer)
+        await self.send_bytes(h, writer, body.getvalue())
+
+    async def handle_put(self, h, reader, writer):
+        h.route = 'upload'
+        chunk = None
+        try:
+            chunk, remain_bytes = await self.run(h.start_chunk)
+            while remain_bytes > 0:
+                data = await self.read_body(h, reader, min(UPLOAD_CHUNK, remain_bytes))
+                if not data:
+                    break
+                remain_bytes -= len(data)
+                h.upload_received += len(data)
+                await self.run(chunk.feed, data)
+            await self.run(h.finish_chunk, chunk)
+        except (UploadError, OSError, asyncio.TimeoutError) as e:
+            h.chunk_failed(chunk, e)
+        await self.flush(h, writer)
+
+    async def send_body(self, h, body, writer):
+        """Async counterpart of SimpleHTTPRequestHandler.send_body."""
+        if not hasattr(body, 'read'):
+            await self.send_stream(h, body, writer)
+        elif isinstance(body, BytesIO):
+            await self.send_bytes(h, writer, body.getvalue())
+        elif not h.ranges:
+            await self.sendfile(h, body, writer, 0, None)
+        elif len(h.ranges) == 1:
+            start, end, _ = h.ranges[0]
+            await self.sendfile(h, body, writer, start, end - start + 1)
+        else:
+            for start, end, part_header in h.ranges:
+                self.write(h, writer, part_header)
+                await self.sendfile(h, body, writer, start, end - start + 1)
+                self.write(h, writer, b'\r\n')
+            self.write(h, writer, h.range_trailer)
+            await self.drained(h, writer)
+
+    async def send_bytes(self, h, writer, data):
+        """Sends an in-memory body, in paced SHAPE_CHUNK slices under rate limits."""
+        if not h.buckets:
+            self.write(h, writer, data)
+            await self.drained(h, writer)
+            return
+        view = memoryview(data)
+        for i in range(0, len(data), SHAPE_CHUNK):
+            chunk = view[i:i + SHAPE_CHUNK]
+            await self.pace(h, len(chunk))
+            self.write(h, writer, chunk)
+            await self.drained(h, writer)
+
+    async def pace(self, h, size):
+        if h.buckets:
+            delay = h.send_delay(size)
+            if delay:
+                metrics.throttled(delay)
+                await asyncio.sleep(delay)
+
+    def check_open(self, writer):
+        # loop.sendfile raises a bare RuntimeError on a transport already closing.
+        if writer.transport.is_closing():
+            raise ConnectionResetError("Connection lost")
+
+    async def sendfile(self, h, f, writer, offset, count):
+        await self.drained(h, writer)
+        if h.buckets:
+            await self.sendfile_shaped(h, f, writer, offset, count)
+            return
+        if h.use_sendfile:
+            # Falls back to executor reads itself when the transport can't
+            # sendfile. Sliced so --timeout bounds each slice rather than the
+            # whole file.
+            while count is None or count > 0:
+                size = SENDFILE_SLICE if count is None else min(SENDFILE_SLICE, count)
+                self.check_open(writer)
+                n = await asyncio.wait_for(self.loop.sendfile(writer.transport, f, offset, size), h.timeout)
+                h.bytes_sent += n
+                if not n:
+                    break
+                offset += n
+                if count is not None:
+                    count -= n
+            return
+        await self.run(f.seek, offset)
+        while count is None or count > 0:
+            size = COPY_BUFSIZE if count is None else min(COPY_BUFSIZE, count)
+            buf = await self.run(f.read, size)
+            if not buf:
+                break
+            self.write(h, writer, buf)
+            await self.drained(h, writer)
+            if count is not None:
+                count -= len(buf)
+
+    async def sendfile_shaped(self, h, f, writer, offset, count):
+        """sendfile in SHAPE_CHUNK slices, each paced by the rate limits.
+
+        Charges only what is sent, like copyfile_shaped.
+        """
+        if count is None:
+            count = file_remaining(f, offset)
+        while count is None or count > 0:
+            size = SHAPE_CHUNK if count is None else min(SHAPE_CHUNK, count)
+            if h.use_sendfile:
+                await self.pace(h, size)
+                self.check_open(writer)
+                n = await asyncio.wait_for(self.loop.sendfile(writer.transport, f, offset, size), h.timeout)
+                h.bytes_sent += n
+            else:
+                await self.run(f.seek, offset)
+                buf = await self.run(f.read, size)
+                n = len(buf)
+                if n:
+                    await self.pace(h, n)
+                    self.write(h, writer, buf)
+                    await self.drained(h, writer)
+            if not n:
+                break
+            offset += n
+            if count is not None:
+                count -= n
+
+    async def send_stream(self, h, chunks, writer):
+        # Listing pages render and compressed files read on the pool, one
+        # chunk at a time.
+        it = iter(chunks)
+        while True:
+            chunk = await self.run(next, it, None)
+            if chunk is None:
+                break
+            if not chunk:
+                continue
+            await self.pace(h, len(chunk))
+            if h.chunked:
+                self.write(h, writer, b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+            else:
+                self.write(h, writer, chunk)
+            await self.drained(h, writer)
+        if h.chunked:
+            self.write(h, writer, b'0\r\n\r\n')
+            await self.drained(h, writer)
+
+
 def translate_path(path):
     path = path.split('?', 1)[0]
     path = path.split('#', 1)[0]
@@ -431,25 +3561,218 @@ def translate_path(path):
     return path
 
 
+running_server = None
+stopping = False
+
+
 def signal_handler(signal, frame):
-    exit()
+    """Drains the running server on the first SIGINT/SIGTERM; exits on the second."""
+    global stopping
+    if stopping or running_server is None:
+        exit()
+    stopping = True
+    running_server.begin_shutdown()
+
+
+def bind_listener(args, reuse_port=False):
+    return socket.create_server((args.bind, args.port), backlog=1024, reuse_port=reuse_port)
+
+
+def serve(args, sock=None, worker=False):
+    """Runs one server process until a signal asks it to stop, then drains it."""
+    global search_index, hash_index, media_index, running_server
+    server_address = (args.bind, args.port)
+    # A terminal Ctrl-C reaches the whole process group; workers leave it to
+    # the supervisor, which forwards a single SIGTERM.
+    signal.signal(signal.SIGINT, signal.SIG_IGN if worker else signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    if not args.no_index:
+        search_index = SearchIndex(os.getcwd())
+        search_index.start(args.index_interval)
+    if args.dedup != 'off':
+        hash_index = HashIndex(os.getcwd(), args.dedup_db or default_cache_db(os.getcwd(), 'hashes'))
+    if not args.no_media:
+        try:
+            media_index = MediaIndex(args.media_db or default_cache_db(os.getcwd(), 'media'), args.probe_workers)
+        except (OSError, ImportError, NotImplementedError, sqlite3.Error) as e:
+            # No process pool on this platform, or no database: serve without.
+            log.warning("Media indexing disabled: %s", e)
+            media_index = None
+    threading.Thread(target=run_session_sweeper, args=(args.upload_session_ttl,), daemon=True).start()
+    limiter = ConnectionLimiter(args.max_connections, args.max_per_ip)
+    if args.engine == 'asyncio':
+        loop = asyncio.new_event_loop()
+        httpd = AsyncHTTPServer(server_address, SimpleHTTPRequestHandler, limiter=limiter, sock=sock)
+        loop.run_until_complete(httpd.start())
+        running_server = httpd
+        loop.run_until_complete(httpd.serve_forever())
+        loop.run_until_complete(httpd.drain(args.drain_timeout))
+    else:
+        httpd = PooledHTTPServer(server_address, SimpleHTTPRequestHandler, args.threads, args.queue_size, limiter, sock)
+        running_server = httpd
+        httpd.serve_forever()
+        httpd.drain(args.drain_timeout)
+    if media_index is not None:
+        media_index.close()
+
+
+class Supervisor:
+    """Forks worker processes that share one listening port and keeps them up.
+
+    Workers either inherit a socket bound here, or with reuse_port bind their
+    own with SO_REUSEPORT so the kernel spreads connections between them.
+    A worker that dies is replaced; on SIGINT/SIGTERM every worker is told to
+    drain and is killed if it hasn't exited within the drain timeout.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.sock = None if args.reuseport else bind_listener(args)
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve(self.args, self.sock or bind_listener(self.args, reuse_port=True), worker=True)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        if self.sock is not None:
+            self.sock.close()
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        timer = threading.Timer(self.args.drain_timeout + 1, self.kill)
+        timer.daemon = True
+        timer.start()
+
+    def kill(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
 
-def _argparse():
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for _ in range(self.args.workers):
+            self.spawn()
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            log.warning("worker %d exited with status %d, restarting", pid, status)
+            if time.monotonic() - started < 1:
+                # Don't spin if workers die straight after starting.
+                time.sleep(1)
+            self.spawn()
+
+
+def setup_logging(args):
+    handler = logging.StreamHandler()
+    if args.log_format == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    log.handlers = [handler]
+    log.setLevel(args.log_level.upper())
+    log.propagate = False
+
+
+def _argparse(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--bind', '-b', metavar='ADDRESS', default='0.0.0.0', help='Specify alternate bind address [default: all interfaces]')
     parser.add_argument('port', action='store', default=8000, type=int, nargs='?', help='Specify alternate port [default: 8000]')
-    return parser.parse_args()
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default='threaded', help='Server engine: a worker thread pool, or one asyncio loop [default: threaded]')
+    parser.add_argument('--workers', type=int, default=1, help='Server processes sharing the port [default: 1]')
+    parser.add_argument('--reuseport', action='store_true', help='Let each worker bind its own socket with SO_REUSEPORT')
+    parser.add_argument('--drain-timeout', type=float, default=10, help='Seconds to let in-flight requests finish on shutdown [default: 10]')
+    parser.add_argument('--threads', type=int, default=64, help='Worker threads for the threaded engine [default: 64]')
+    parser.add_argument('--queue-size', type=int, default=64, help='Accepted connections that may wait for a worker [default: 64]')
+    parser.add_argument('--max-connections', type=int, default=0, help='Open connections allowed in total, 0 for no limit [default: 0]')
+    parser.add_argument('--max-per-ip', type=int, default=0, help='Open connections allowed per client IP, 0 for no limit [default: 0]')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds a socket read or write may stall [default: 60]')
+    parser.add_argument('--keepalive-timeout', type=float, default=5, help='Seconds an idle keep-alive connection is kept open [default: 5]')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Total upstream bandwidth in MB/s, 0 for no limit [default: 0]')
+    parser.add_argument('--ip-rate-limit', type=float, default=0, help='Bandwidth per client IP in MB/s, 0 for no limit [default: 0]')
+    parser.add_argument('--connection-rate-limit', type=float, default=0, help='Bandwidth per connection in MB/s, 0 for no limit [default: 0]')
+    parser.add_argument('--no-sendfile', action='store_true', help='Disable the zero-copy sendfile path for downloads')
+    parser.add_argument('--no-index', action='store_true', help='Disable the recursive search index and search only the top directory')
+    parser.add_argument('--index-interval', type=float, default=30, help='Seconds between search index refreshes [default: 30]')
+    parser.add_argument('--no-media', action='store_true', help='Disable media metadata (dimensions, duration) in listings and search')
+    parser.add_argument('--media-db', metavar='FILE', help='Media metadata cache [default: under ~/.cache/mediamaestro]')
+    parser.add_argument('--probe-workers', type=int, default=2, help='Background processes probing media headers [default: 2]')
+    parser.add_argument('--max-upload-size', type=int, default=0, help='Largest accepted file per upload in MB, 0 for no limit [default: 0]')
+    parser.add_argument('--upload-session-ttl', type=float, default=24 * 60 * 60, help='Seconds a resumable upload may go without a chunk before it is deleted [default: 86400]')
+    parser.add_argument('--dedup', choices=['off', 'link', 'refuse'], default='off', help='Store uploads identical to an existing file as hardlinks, or refuse them [default: off]')
+    parser.add_argument('--dedup-db', metavar='FILE', help='Hash database for --dedup [default: under ~/.cache/mediamaestro]')
+    parser.add_argument('--max-request-size', type=int, default=0, help='Largest accepted upload request in MB, 0 for no limit [default: 0]')
+    parser.add_argument('--no-compress', action='store_true', help='Disable gzip/brotli content encoding')
+    parser.add_argument('--compress-cache-size', type=int, default=32, help='Memory for compressed copies of hot files in MB [default: 32]')
+    parser.add_argument('--cache-control', default='no-cache', help='Cache-Control sent with files [default: no-cache]')
+    parser.add_argument('--listing-cache-size', type=int, default=64, help='Memory for cached directory listings in MB, 0 to disable [default: 64]')
+    parser.add_argument('--scan-cache-size', type=int, default=64, help='Memory for scanned directories kept for paging in MB, 0 to disable [default: 64]')
+    parser.add_argument('--listing-cache-control', default='no-cache', help='Cache-Control sent with directory listings [default: no-cache]')
+    parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='info', help='Least severe messages to log; warning silences the access log [default: info]')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help='Log lines as plain text or one JSON object each [default: text]')
+    parser.add_argument('--no-metrics', action='store_true', help='Disable the /metrics endpoint')
+    return parser.parse_args(argv)
+
+def configure(args):
+    """Applies the parsed options to the handler class and module caches."""
+    global shaper
+    SimpleHTTPRequestHandler.use_sendfile = not args.no_sendfile
+    SimpleHTTPRequestHandler.timeout = args.timeout
+    SimpleHTTPRequestHandler.keepalive_timeout = args.keepalive_timeout
+    SimpleHTTPRequestHandler.cache_control = args.cache_control
+    SimpleHTTPRequestHandler.listing_cache_control = args.listing_cache_control
+    SimpleHTTPRequestHandler.max_upload_size = args.max_upload_size * 1024 * 1024
+    SimpleHTTPRequestHandler.max_request_size = args.max_request_size * 1024 * 1024
+    SimpleHTTPRequestHandler.compress = not args.no_compress
+    SimpleHTTPRequestHandler.metrics_enabled = not args.no_metrics
+    SimpleHTTPRequestHandler.upload_session_ttl = args.upload_session_ttl
+    SimpleHTTPRequestHandler.dedup = args.dedup
+    listing_cache.max_bytes = args.listing_cache_size * 1024 * 1024
+    scan_cache.max_bytes = args.scan_cache_size * 1024 * 1024
+    compressed_cache.max_bytes = args.compress_cache_size * 1024 * 1024
+    shaper = None
+    if args.rate_limit or args.ip_rate_limit or args.connection_rate_limit:
+        mb = 1024 * 1024
+        shaper = BandwidthShaper(args.rate_limit * mb, args.ip_rate_limit * mb, args.connection_rate_limit * mb)
+    setup_logging(args)
+
 
 def main():
     args = _argparse()
-    server_address = (args.bind, args.port)
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    httpd = ThreadingHTTPServer(server_address, SimpleHTTPRequestHandler)
-    server = httpd.socket.getsockname()
+    configure(args)
     print("sys encoding: " + sys.getdefaultencoding())
+    if args.workers > 1:
+        supervisor = Supervisor(args)
+        server = (args.bind, args.port) if supervisor.sock is None else supervisor.sock.getsockname()
+        print("Serving http on: " + str(server[0]) + ", port: " + str(server[1]) + " ... (http://" + server[0] + ":" + str(server[1]) + "/) with " + str(args.workers) + " workers")
+        supervisor.run()
+        return
+    sock = bind_listener(args)
+    server = sock.getsockname()
     print("Serving http on: " + str(server[0]) + ", port: " + str(server[1]) + " ... (http://" + server[0] + ":" + str(server[1]) + "/)")
-    httpd.serve_forever()
+    serve(args, sock)
 
 if __name__ == '__main__':
     main()
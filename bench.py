@@ -0,0 +1,585 @@
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import http.client
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+GB = 1024 ** 3
+
+
+def free_port():
+    """Asks the kernel for an unused local port."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_file(path, size, sparse=False):
+    """Writes size bytes of incompressible data to path.
+
+    A sparse file of zeros is made instantly instead, which is how multi-GB
+    downloads are benchmarked without filling the disk.
+    """
+    if sparse:
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        return
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def make_tree(root, entries, per_dir=1000, seed=0):
+    """Builds a synthetic media tree of about entries names under root/tree.
+
+    root/tree/flat holds per_dir files for listing benchmarks; the rest are
+    spread over nested album directories so the search index has depth.
+    File sizes are random but fixed by seed, and files are sparse.
+    """
+    rng = random.Random(seed)
+    tree = os.path.join(root, 'tree')
+    flat = os.path.join(tree, 'flat')
+    os.makedirs(flat)
+    flat_count = min(per_dir, entries)
+    for i in range(flat_count):
+        make_file(os.path.join(flat, 'track%06d.mp3' % i), rng.randrange(1 << 24), sparse=True)
+    made = flat_count
+    album = 0
+    while made < entries:
+        d = os.path.join(tree, 'artist%03d' % (album // 50), 'album%05d' % album)
+        os.makedirs(d)
+        for i in range(min(20, entries - made)):
+            make_file(os.path.join(d, 'song%05d_%02d.flac' % (album, i)), rng.randrange(1 << 26), sparse=True)
+            made += 1
+        album += 1
+    return tree
+
+
+# Access logging costs depend on where the log goes; leave it out unless a
+# benchmark is run with --server-args '--log-level info'.
+SERVER_DEFAULTS = ['--log-level', 'warning']
+
+
+class Server:
+    """Runs app.py as a subprocess so its CPU time can be measured on its own."""
+
+    def __init__(self, root, *extra):
+        self.port = free_port()
+        self.proc = subprocess.Popen(
+            [sys.executable, APP, '--bind', '127.0.0.1', str(self.port)] + SERVER_DEFAULTS + list(extra),
+            cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.2).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError("server did not start")
+
+    def wait_for_index(self, timeout=600):
+        """Polls /metrics until the search index has finished its first walk."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port)
+            conn.request('GET', '/metrics')
+            body = conn.getresponse().read()
+            conn.close()
+            if b'mediamaestro_search_index_ready 1' in body:
+                return
+            time.sleep(0.1)
+        raise RuntimeError("search index not ready")
+
+    def peak_rss(self):
+        """Returns the server's peak resident set size in kB (Linux only)."""
+        try:
+            with open('/proc/%d/status' % self.proc.pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        """Stops the server and returns the CPU seconds it used."""
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.proc.terminate()
+        self.proc.wait()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+
+class InProcessServer:
+    """Runs the server on a thread of this process.
+
+    Startup is cheaper and a profiler sees the server code, but the client
+    shares the GIL with it, so CPU time is not reported.
+    """
+
+    def __init__(self, root, *extra):
+        sys.path.insert(0, os.path.dirname(APP))
+        import app
+        self.app = app
+        args = app._argparse(['--bind', '127.0.0.1', '0'] + SERVER_DEFAULTS + list(extra))
+        app.configure(args)
+        self.cwd = os.getcwd()
+        os.chdir(root)
+        app.search_index = None
+        if not args.no_index:
+            app.search_index = app.SearchIndex(os.getcwd())
+        app.media_index = None
+        if not args.no_media:
+            app.media_index = app.MediaIndex(args.media_db or app.default_cache_db(os.getcwd(), 'media'),
+                                             args.probe_workers)
+        handler = app.SimpleHTTPRequestHandler
+        if args.engine == 'asyncio':
+            self.loop = asyncio.new_event_loop()
+            self.httpd = app.AsyncHTTPServer(('127.0.0.1', 0), handler)
+            self.loop.run_until_complete(self.httpd.start())
+            self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self.httpd.serve_forever(),))
+        else:
+            self.loop = None
+            self.httpd = app.PooledHTTPServer(('127.0.0.1', 0), handler, args.threads, args.queue_size)
+            self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.port = self.httpd.socket.getsockname()[1]
+        self.thread.start()
+
+    def wait_for_index(self, timeout=None):
+        index = self.app.search_index
+        if index is not None and not index.ready:
+            index.refresh()
+            index.ready = True
+
+    def peak_rss(self):
+        return None
+
+    def stop(self):
+        self.httpd.begin_shutdown()
+        self.thread.join()
+        if self.loop is not None:
+            self.loop.close()
+        else:
+            self.httpd.server_close()
+        if self.app.media_index is not None:
+            self.app.media_index.close()
+        os.chdir(self.cwd)
+        return None
+
+
+def start_server(args, root, *extra):
+    cls = InProcessServer if args.in_process else Server
+    # Keep the server's databases in the temporary root, not in the user's
+    # cache directory, where they would be keyed by a path about to vanish.
+    # --server-args comes last and can still point them elsewhere.
+    state = ['--media-db', os.path.join(root, '.bench-media.db'),
+             '--dedup-db', os.path.join(root, '.bench-hashes.db')]
+    return cls(root, *(state + list(extra) + args.server_args.split()))
+
+
+def fetch(conn, path):
+    """GETs path on a kept-alive connection, returning (seconds, body size)."""
+    start = time.perf_counter()
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    body = resp.read()
+    if resp.status != 200:
+        raise RuntimeError("%s returned %d" % (path, resp.status))
+    return time.perf_counter() - start, len(body)
+
+
+def latency_stats(latencies):
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+def report(results, result):
+    """Prints one result line and keeps it for the JSON report."""
+    results.append(result)
+    print('  '.join('%s %s' % (k, '%.1f' % v if isinstance(v, float) else v) for k, v in result.items()))
+
+
+def download(port, path):
+    """Fetches path and discards the body, returning the number of bytes read."""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    buf = bytearray(1024 * 1024)
+    view = memoryview(buf)
+    total = 0
+    while True:
+        n = resp.readinto(view)
+        if not n:
+            break
+        total += n
+    conn.close()
+    return total
+
+
+def upload(port, path, size, name='blob.bin'):
+    """POSTs size bytes as one multipart file part, streaming from memory."""
+    boundary = 'bench%d' % size
+    head = ('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name)).encode()
+    tail = ('\r\n--%s--\r\n' % boundary).encode()
+    block = os.urandom(1024 * 1024)
+
+    def body():
+        yield head
+        remaining = size
+        while remaining > 0:
+            yield block[:remaining]
+            remaining -= len(block)
+        yield tail
+
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.putrequest('POST', path)
+    conn.putheader('Content-Type', 'multipart/form-data; boundary=' + boundary)
+    conn.putheader('Content-Length', str(len(head) + size + len(tail)))
+    conn.endheaders()
+    for chunk in body():
+        conn.send(chunk)
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    return resp.status
+
+
+def cpu_per_gb(cpu, total):
+    return None if cpu is None else cpu / (total / GB)
+
+
+def resumable_upload(port, path, size, name, parallel, chunk_size):
+    """Uploads size bytes through a resumable session, parallel chunks at a time."""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '%s?upload=new&name=%s&size=%d' % (path, name, size))
+    resp = conn.getresponse()
+    resp.read()
+    location = resp.getheader('Location')
+    conn.close()
+    block = os.urandom(chunk_size)
+    offsets = list(range(0, size, chunk_size))
+    lock = threading.Lock()
+
+    def sender():
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        while True:
+            with lock:
+                if not offsets:
+                    break
+                start = offsets.pop()
+            body = block[:min(chunk_size, size - start)]
+            conn.request('PUT', location, body, {'Content-Range': 'bytes %d-%d/%d' % (start, start + len(body) - 1, size)})
+            conn.getresponse().read()
+        conn.close()
+
+    threads = [threading.Thread(target=sender) for _ in range(parallel)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', location)
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    return resp.status
+
+
+def bench_download(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        make_file(os.path.join(root, 'blob.bin'), args.size * 1024 * 1024, args.sparse)
+        modes = [('sendfile', []), ('copyfileobj', ['--no-sendfile'])]
+        for name, extra in modes:
+            server = start_server(args, root, *extra)
+            start = time.perf_counter()
+            total = 0
+            for _ in range(args.repeat):
+                total += download(server.port, '/blob.bin')
+            elapsed = time.perf_counter() - start
+            cpu = server.stop()
+            report(results, {'bench': 'download', 'mode': name, 'size_mb': args.size,
+                             'mb_per_s': total / elapsed / 1024 / 1024, 'cpu_s_per_gb': cpu_per_gb(cpu, total)})
+
+
+def bench_upload(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        server = start_server(args, root)
+        size = args.size * 1024 * 1024
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            upload(server.port, '/', size, 'blob%d.bin' % i)
+        elapsed = time.perf_counter() - start
+        cpu = server.stop()
+        total = size * args.repeat
+        report(results, {'bench': 'upload', 'mode': 'multipart', 'size_mb': args.size,
+                         'mb_per_s': total / elapsed / 1024 / 1024, 'cpu_s_per_gb': cpu_per_gb(cpu, total)})
+        for parallel in args.parallel:
+            server = start_server(args, root)
+            start = time.perf_counter()
+            for i in range(args.repeat):
+                resumable_upload(server.port, '/', size, 'chunked%d_%d.bin' % (parallel, i), parallel, args.chunk_size * 1024 * 1024)
+            elapsed = time.perf_counter() - start
+            cpu = server.stop()
+            report(results, {'bench': 'upload', 'mode': 'resumable', 'parallel': parallel, 'size_mb': args.size,
+                             'mb_per_s': total / elapsed / 1024 / 1024, 'cpu_s_per_gb': cpu_per_gb(cpu, total)})
+
+
+def bench_listing(args, results):
+    """Listing latency for one big directory, whole and paginated, per tree size."""
+    rng = random.Random(args.seed)
+    for entries in args.entries:
+        with tempfile.TemporaryDirectory() as root:
+            make_tree(root, entries, per_dir=entries, seed=args.seed)
+            server = start_server(args, root, '--no-index')
+            conn = http.client.HTTPConnection('127.0.0.1', server.port)
+            pages = [('full', lambda: '/tree/flat/'),
+                     ('json', lambda: '/tree/flat/?format=json'),
+                     ('page', lambda: '/tree/flat/?limit=100&offset=%d' % rng.randrange(entries))]
+            for name, make_path in pages:
+                first, size = fetch(conn, make_path())
+                latencies = [fetch(conn, make_path())[0] for _ in range(args.repeat)]
+                result = {'bench': 'listing', 'entries': entries, 'page': name,
+                          'first_ms': first * 1000, 'bytes': size}
+                result.update(latency_stats(latencies))
+                report(results, result)
+            conn.close()
+            server.stop()
+
+
+def bench_search(args, results):
+    """Search latency over the whole tree once the index has been built."""
+    rng = random.Random(args.seed)
+    for entries in args.entries:
+        with tempfile.TemporaryDirectory() as root:
+            make_tree(root, entries, seed=args.seed)
+            server = start_server(args, root)
+            start = time.perf_counter()
+            server.wait_for_index()
+            index_s = time.perf_counter() - start
+            conn = http.client.HTTPConnection('127.0.0.1', server.port)
+            albums = max(entries // 20, 1)
+            queries = [('rare', lambda: 'song%05d_%02d' % (rng.randrange(albums), rng.randrange(20))),
+                       ('common', lambda: 'album%03d' % rng.randrange(max(albums // 100, 1))),
+                       ('miss', lambda: 'nomatch%d' % rng.randrange(1000))]
+            for name, make_query in queries:
+                latencies = [fetch(conn, '/search?q=' + make_query())[0] for _ in range(args.repeat)]
+                result = {'bench': 'search', 'entries': entries, 'query': name, 'index_s': index_s}
+                result.update(latency_stats(latencies))
+                report(results, result)
+            conn.close()
+            server.stop()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+async def slow_client(port, path, requests, read_delay, latencies, errors):
+    """Fetches path repeatedly, sleeping between reads like a slow player."""
+    for _ in range(requests):
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET %s HTTP/1.0\r\nHost: bench\r\n\r\n' % path.encode())
+            await writer.drain()
+            while await reader.read(64 * 1024):
+                if read_delay:
+                    await asyncio.sleep(read_delay)
+            writer.close()
+        except OSError:
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_clients(port, args):
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        slow_client(port, args.path, args.requests, args.read_delay / 1000.0, latencies, errors)
+        for _ in range(args.clients)])
+    return time.perf_counter() - start, latencies, len(errors)
+
+
+def bench_concurrency(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        make_file(os.path.join(root, 'media.bin'), args.media_size * 1024)
+        for i in range(200):
+            make_file(os.path.join(root, 'file%03d.txt' % i), 100)
+        for engine in args.engines:
+            server = start_server(args, root, '--engine', engine)
+            elapsed, latencies, errors = asyncio.run(run_clients(server.port, args))
+            rss = server.peak_rss()
+            cpu = server.stop()
+            result = {'bench': 'concurrency', 'engine': engine, 'clients': args.clients,
+                      'req_per_s': len(latencies) / elapsed, 'errors': errors,
+                      'server_cpu_s': cpu, 'peak_rss_kb': rss}
+            if latencies:
+                result.update(latency_stats(latencies))
+            report(results, result)
+
+
+def bench_shaping(args, results):
+    """Listing and small-file latency while bulk downloads saturate the server."""
+    with tempfile.TemporaryDirectory() as root:
+        make_file(os.path.join(root, 'big.bin'), args.size * 1024 * 1024, args.sparse)
+        make_file(os.path.join(root, 'small.txt'), 4096)
+        make_tree(root, 1000, seed=args.seed)
+        modes = [('unlimited', []), ('rate-limit', ['--rate-limit', str(args.rate)])]
+        for name, extra in modes:
+            server = start_server(args, root, *extra)
+            stop = threading.Event()
+            bulk = []
+
+            def downloader():
+                while not stop.is_set():
+                    bulk.append(download(server.port, '/big.bin'))
+
+            threads = [threading.Thread(target=downloader) for _ in range(args.downloads)]
+            for t in threads:
+                t.start()
+            time.sleep(0.5)
+            conn = http.client.HTTPConnection('127.0.0.1', server.port)
+            start = time.perf_counter()
+            latencies = []
+            for _ in range(args.repeat):
+                latencies.append(fetch(conn, '/tree/flat/')[0])
+                latencies.append(fetch(conn, '/small.txt')[0])
+            elapsed = time.perf_counter() - start
+            conn.close()
+            stop.set()
+            for t in threads:
+                t.join()
+            server.stop()
+            result = {'bench': 'shaping', 'mode': name, 'downloads': args.downloads,
+                      'bulk_mb': sum(bulk) / 1024 / 1024, 'interactive_req_per_s': len(latencies) / elapsed}
+            result.update(latency_stats(latencies))
+            report(results, result)
+
+
+def bench_suite(args, results):
+    """Runs every benchmark with the suite's sizes, for comparing commits."""
+    for func in (bench_listing, bench_search, bench_download, bench_upload, bench_concurrency, bench_shaping):
+        func(args, results)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(APP),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def add_concurrency_args(p, clients, requests):
+    p.add_argument('--clients', type=int, default=clients, help='Concurrent clients [default: %d]' % clients)
+    p.add_argument('--requests', type=int, default=requests, help='Requests per client [default: %d]' % requests)
+    p.add_argument('--path', default='/media.bin', help='Path each client fetches [default: /media.bin]')
+    p.add_argument('--read-delay', type=float, default=5, help='Milliseconds a client sleeps between 64 KB reads [default: 5]')
+    p.add_argument('--engines', nargs='+', default=['threaded', 'asyncio'], help='Engines to compare [default: threaded asyncio]')
+
+
+def add_shaping_args(p):
+    p.add_argument('--downloads', type=int, default=4, help='Concurrent bulk downloads of big.bin [default: 4]')
+    p.add_argument('--rate', type=float, default=50, help='--rate-limit for the shaped run, in MB/s [default: 50]')
+
+
+def add_resumable_args(p):
+    p.add_argument('--parallel', type=int, nargs='*', default=[1, 4], help='Concurrent chunk PUTs to try for resumable uploads [default: 1 4]')
+    p.add_argument('--chunk-size', type=int, default=8, help='Resumable upload chunk size in MB [default: 8]')
+
+
+def _argparse():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--json', metavar='FILE', help='Also write the results as JSON to FILE, - for stdout')
+    common.add_argument('--in-process', action='store_true', help='Run the server on a thread of the benchmark process')
+    common.add_argument('--server-args', default='', help='Extra options for the server, e.g. "--engine asyncio"')
+    common.add_argument('--seed', type=int, default=0, help='Seed for synthetic trees and request mixes [default: 0]')
+    common.add_argument('--sparse', action='store_true', help='Serve sparse files so multi-GB sizes need no disk')
+    parser = argparse.ArgumentParser(description='Benchmarks for the MediaMaestro server')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    p = sub.add_parser('download', parents=[common], help='Compare download throughput and CPU per GB')
+    p.add_argument('--size', type=int, default=512, help='File size in MB [default: 512]')
+    p.add_argument('--repeat', type=int, default=4, help='Downloads per mode [default: 4]')
+    p.set_defaults(func=bench_download)
+    p = sub.add_parser('upload', parents=[common], help='Measure multipart upload throughput and CPU per GB')
+    p.add_argument('--size', type=int, default=256, help='File size in MB [default: 256]')
+    p.add_argument('--repeat', type=int, default=4, help='Uploads to time [default: 4]')
+    add_resumable_args(p)
+    p.set_defaults(func=bench_upload)
+    p = sub.add_parser('listing', parents=[common], help='Measure directory listing latency by directory size')
+    p.add_argument('--entries', type=int, nargs='+', default=[10, 1000, 10000, 100000], help='Directory sizes [default: 10 1000 10000 100000]')
+    p.add_argument('--repeat', type=int, default=50, help='Timed requests per page type [default: 50]')
+    p.set_defaults(func=bench_listing)
+    p = sub.add_parser('search', parents=[common], help='Measure search latency by tree size')
+    p.add_argument('--entries', type=int, nargs='+', default=[10, 1000, 10000, 100000], help='Tree sizes [default: 10 1000 10000 100000]')
+    p.add_argument('--repeat', type=int, default=200, help='Timed queries per query type [default: 200]')
+    p.set_defaults(func=bench_search)
+    p = sub.add_parser('concurrency', parents=[common], help='Compare server engines under many concurrent slow clients')
+    add_concurrency_args(p, 200, 5)
+    p.add_argument('--size', dest='media_size', type=int, default=1024, help='Size of media.bin in KB [default: 1024]')
+    p.set_defaults(func=bench_concurrency)
+    p = sub.add_parser('shaping', parents=[common], help='Measure interactive latency next to bulk downloads, with and without --rate-limit')
+    p.add_argument('--size', type=int, default=256, help='Size of big.bin in MB [default: 256]')
+    p.add_argument('--repeat', type=int, default=100, help='Listing/small-file request pairs to time [default: 100]')
+    add_shaping_args(p)
+    p.set_defaults(func=bench_shaping)
+    p = sub.add_parser('suite', parents=[common], help='Run every benchmark at moderate sizes')
+    p.add_argument('--entries', type=int, nargs='+', default=[10, 1000, 10000], help='Tree sizes [default: 10 1000 10000]')
+    p.add_argument('--repeat', type=int, default=20, help='Repetitions per measurement [default: 20]')
+    p.add_argument('--size', type=int, default=64, help='Download/upload size in MB [default: 64]')
+    p.add_argument('--media-size', type=int, default=1024, help='Size of media.bin for the concurrency run in KB [default: 1024]')
+    add_concurrency_args(p, 50, 5)
+    add_resumable_args(p)
+    add_shaping_args(p)
+    p.set_defaults(func=bench_suite)
+    return parser.parse_args()
+
+
+def main():
+    args = _argparse()
+    results = []
+    args.func(args, results)
+    if args.json:
+        doc = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'args': {k: v for k, v in vars(args).items() if k != 'func'},
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(doc, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(doc, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()